@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Benchmark du rendu des factures, étape par étape
+
+Chaque étape du pipeline est mesurée sur des factures types. Les résultats
+peuvent être enregistrés en JSON (-o) et comparés à un run précédent
+(--compare) : toute étape plus lente que le seuil est signalée.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import invoice_batch
+import invoice_ledger
+import invoice_renderer
+import invoice_totals
+
+TYPICAL_INVOICE = {
+    "numero_de_facture": "2026-0042",
+    "date": "18/10/2026",
+    "nom": "SARL Dupont",
+    "adresse": "12 rue de la Paix",
+    "ville": "75002 Paris",
+    "num_rc": "RC 123 456",
+    "tva": "FR12345678901",
+    "document": "Devis 17",
+    "lieu_d_intervention": "Montreuil",
+    "debut_du_chantier": "01/09/2026",
+    "fin_du_chantier": "30/09/2026",
+    "libelle_1": "Ravalement façade côté rue avec échafaudage et nettoyage haute pression",
+    "quantite_1": "12",
+    "prix_unitaire_1": "45.50 €",
+    "total_net_1": "546.00 €",
+    "libelle_2": "Peinture",
+    "quantite_2": "3",
+    "prix_unitaire_2": "20.00 €",
+    "total_net_2": "60.00 €",
+    "libelle_3": "Nettoyage de fin de chantier",
+    "quantite_3": "1",
+    "prix_unitaire_3": "150.00 €",
+    "total_net_3": "150.00 €",
+    "libelle_4": "Évacuation des gravats",
+    "quantite_4": "2",
+    "prix_unitaire_4": "80.00 €",
+    "total_net_4": "160.00 €",
+    "total_hors_taxe": "916.00 €",
+    "tva_10_pourcent": "91.60 €",
+    "total_net_de_taxes": "1007.60 €",
+    "acompte_percu": "100.00 €",
+    "reste_a_payer": "907.60 €",
+    "en_votre_aimable_reglement_de_la_somme_de": "908",
+    "additions_speciales": "Paiement à 30 jours. Merci de rappeler le numéro de facture lors du virement.",
+}
+
+_LONG_TEXT = ("Ravalement complet de la façade côté rue avec installation d'échafaudage, "
+              "nettoyage haute pression, rebouchage des fissures et application de deux couches "
+              "de peinture microporeuse ")
+
+FIXTURES = {
+    "vide": {field_name: "" for field_name in TYPICAL_INVOICE},
+    "type_4_lignes": TYPICAL_INVOICE,
+    "libelle_long": dict(TYPICAL_INVOICE, **{f"libelle_{i}": _LONG_TEXT * 2 for i in range(1, 5)}),
+    "additions_longues": dict(TYPICAL_INVOICE, additions_speciales=_LONG_TEXT * 12),
+}
+
+
+def measure(func, iterations):
+    """Run func repeatedly and return its timings in milliseconds"""
+    func()  # warm up
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {"median_ms": statistics.median(timings), "min_ms": min(timings)}
+
+
+def wrapped_fields(values, layout):
+    """(text, field layout) for every field of the fixture that goes through wrapping"""
+    items = []
+    for field_name, value in values.items():
+        spec = layout.get(field_name)
+        if value and spec is not None and spec.wrap_width is not None:
+            items.append((value, spec))
+    return items
+
+
+def bench_fixture(name, values, iterations):
+    """Time every stage of the pipeline for one fixture"""
+    template = invoice_renderer.load_template()
+    layout = invoice_renderer.load_layout()
+    height = template.height
+    results = {}
+
+    def compile_cold():
+        invoice_renderer.compile_field.cache_clear()
+        invoice_renderer.compile_fields(values, height, layout)
+    results[f"compilation/{name}"] = measure(compile_cold, iterations)
+
+    wrapped = wrapped_fields(values, layout)
+    if wrapped:
+        def wrap_cold():
+            invoice_renderer.text_width.cache_clear()
+            for text, spec in wrapped:
+                invoice_renderer.wrap_text(text, spec.font_name, spec.font_size, spec.wrap_width)
+        results[f"coupure_texte/{name}"] = measure(wrap_cold, iterations)
+
+    ops = invoice_renderer.compile_fields(values, height, layout)
+    results[f"overlay/{name}/canvas"] = measure(
+        lambda: invoice_renderer.canvas_overlay(ops, template), iterations)
+    results[f"overlay/{name}/stream"] = measure(
+        lambda: invoice_renderer.stream_overlay(ops), iterations)
+
+    overlay_page = invoice_renderer.canvas_overlay(ops, template)
+    overlay = invoice_renderer.stream_overlay(ops)
+    with template.lock:
+        results[f"fusion/{name}/canvas"] = measure(
+            lambda: template.merge_overlay(overlay_page), iterations)
+        results[f"fusion/{name}/stream"] = measure(
+            lambda: template.append_overlay(overlay), iterations)
+        template.append_overlay(overlay)
+        results[f"ecriture/{name}"] = measure(lambda: template.write(io.BytesIO()), iterations)
+
+    for backend in invoice_renderer.BACKENDS:
+        results[f"rendu_complet/{name}/{backend}"] = measure(
+            lambda: invoice_renderer.render_invoice(values, backend=backend), iterations)
+    return results
+
+
+def bench_batch(count, workers):
+    """Throughput of the batch renderer on count typical invoices"""
+    records = [dict(TYPICAL_INVOICE, numero_de_facture=f"BENCH-{i:05d}") for i in range(count)]
+    results = {}
+    with tempfile.TemporaryDirectory() as output_dir:
+        for backend in invoice_renderer.BACKENDS:
+            start = time.perf_counter()
+            invoice_batch.run_batch(records, output_dir, backend, workers=workers)
+            elapsed = time.perf_counter() - start
+            results[f"lot_{count}/{backend}"] = {
+                "median_ms": elapsed * 1000 / count,
+                "min_ms": elapsed * 1000 / count,
+                "factures_par_s": count / elapsed,
+            }
+    return results
+
+
+def long_invoice(line_count):
+    """Typical invoice with line_count line items"""
+    values = dict(TYPICAL_INVOICE)
+    for i in range(1, line_count + 1):
+        values[f"libelle_{i}"] = f"Fourniture n° {i}"
+        values[f"quantite_{i}"] = "2"
+        values[f"prix_unitaire_{i}"] = "12.50 €"
+        values[f"total_net_{i}"] = "25.00 €"
+    return values
+
+
+def _peak_rss_child(line_count):
+    """Render a line_count line invoice to a file and print the peak RSS in kB (child process)"""
+    import resource
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        invoice_renderer.write_invoice(long_invoice(line_count), os.path.join(output_dir, "facture.pdf"),
+                                       backend=invoice_renderer.BACKEND_STREAM)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024  # bytes on macOS, kB elsewhere
+    print(peak)
+
+
+def bench_memory(line_counts=(10, 10000)):
+    """Peak RSS of rendering one invoice per line count, each in a fresh process"""
+    try:
+        import resource  # noqa: F401
+    except ImportError:
+        print("  (mesure de mémoire indisponible sur cette plateforme)")
+        return {}
+    results = {}
+    for line_count in line_counts:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--rss-child", str(line_count)],
+                                check=True, capture_output=True, text=True).stdout
+        results[f"memoire/{line_count}_lignes"] = {"peak_rss_mb": int(output.split()[-1]) / 1024}
+    return results
+
+
+def bench_ledger(row_count, iterations):
+    """Indexed lookups in a ledger holding row_count invoices"""
+    clients = [f"Client {i:05d}" for i in range(1000)]
+    with tempfile.TemporaryDirectory() as ledger_dir:
+        ledger = invoice_ledger.InvoiceLedger(os.path.join(ledger_dir, "registre.db"))
+        # Filled in one transaction: recording row by row is what the renders do, not what is measured
+        with ledger.connection:
+            ledger.connection.executemany(
+                "INSERT INTO invoices (numero, client, invoice_date, total_ht_cents, total_ttc_cents, "
+                "amount_cents, output_path, fields, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, '{}', '', '')",
+                ((f"2026-{i:06d}", clients[i % len(clients)], f"20{20 + i % 7}-{1 + i % 12:02d}-{1 + i % 28:02d}",
+                  i % 500000, i % 500000, i % 500000, f"FACTURE_2026-{i:06d}.pdf") for i in range(row_count)),
+            )
+        numero = f"2026-{row_count // 2:06d}"
+        lookups = {
+            "numero": lambda: ledger.get(numero),
+            "client_trimestre": lambda: ledger.find("Client 00042", "01/07/2024", "30/09/2024"),
+            "montant": lambda: ledger.find(min_amount="1000", max_amount="1010"),
+            "date": lambda: ledger.find(date_from="2025-03-01", date_to="2025-03-01", limit=50),
+        }
+        results = {f"registre_{row_count}/{name}": measure(func, iterations) for name, func in lookups.items()}
+        ledger.close()
+    return results
+
+
+def bench_totals(count, iterations):
+    """Totals of count 4-line invoices, one graph per invoice and column by column"""
+    records = []
+    for i in range(count):
+        values = {"tva_20_pourcent": "20.00 €", "acompte_percu": f"{i % 100}"}
+        for line in range(1, 5):
+            values[f"quantite_{line}"] = str(1 + (i + line) % 7)
+            values[f"prix_unitaire_{line}"] = f"{12.5 + line * 0.335:.3f} €"
+        records.append(values)
+    return {
+        f"totaux_{count}/par_facture": measure(
+            lambda: [invoice_totals.compute_totals(values) for values in records], iterations),
+        f"totaux_{count}/colonnes": measure(lambda: invoice_totals.compute_totals_batch(records), iterations),
+    }
+
+
+def run_suite(iterations, batch_size, workers, memory=True, ledger_rows=0):
+    results = {}
+    for name, values in FIXTURES.items():
+        results.update(bench_fixture(name, values, iterations))
+    results.update(bench_totals(1000, max(1, iterations // 10)))
+    if batch_size:
+        results.update(bench_batch(batch_size, workers))
+    if memory:
+        results.update(bench_memory())
+    if ledger_rows:
+        results.update(bench_ledger(ledger_rows, iterations))
+    return {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": iterations,
+            "batch_size": batch_size,
+            "workers": workers,
+        },
+        "results": results,
+    }
+
+
+def print_results(report):
+    for stage, timing in report["results"].items():
+        if "peak_rss_mb" in timing:
+            print(f"  {stage:<40} {timing['peak_rss_mb']:9.1f} Mo (pic de mémoire)")
+            continue
+        line = f"  {stage:<40} {timing['median_ms']:9.3f} ms (min {timing['min_ms']:.3f})"
+        if "factures_par_s" in timing:
+            line += f"  {timing['factures_par_s']:.0f} factures/s"
+        print(line)
+
+
+def compare(report, baseline, threshold):
+    """Print the change of every stage against a baseline; return the stages slower than threshold"""
+    regressions = []
+    print(f"\nComparaison avec {baseline['meta'].get('date', '?')} (seuil {threshold:.0%})")
+    for stage, timing in report["results"].items():
+        before = baseline["results"].get(stage)
+        key = "peak_rss_mb" if "peak_rss_mb" in timing else "median_ms"
+        if not before or not before.get(key):
+            continue
+        change = timing[key] / before[key] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  <-- RÉGRESSION"
+            regressions.append(stage)
+        unit = "Mo" if key == "peak_rss_mb" else "ms"
+        print(f"  {stage:<40} {before[key]:9.3f} -> {timing[key]:9.3f} {unit} {change:+7.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark du rendu des factures")
+    parser.add_argument("-n", "--iterations", type=int, default=50,
+                        help="nombre de mesures par étape")
+    parser.add_argument("--batch", type=int, default=200,
+                        help="taille du lot pour le débit (0 pour ne pas le mesurer)")
+    parser.add_argument("-j", "--workers", type=int, default=1,
+                        help="processus de rendu pour le lot")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="ne mesure pas le pic de mémoire à 10 et 10 000 lignes")
+    parser.add_argument("--ledger-rows", type=int, default=100000,
+                        help="taille du registre pour les recherches (0 pour ne pas les mesurer)")
+    parser.add_argument("--rss-child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("-o", "--output", help="enregistre les résultats dans ce fichier JSON")
+    parser.add_argument("--compare", metavar="JSON", help="résultats de référence à comparer")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="ralentissement toléré avant signalement (0.10 = 10%%)")
+    args = parser.parse_args(argv)
+    if args.rss_child is not None:
+        _peak_rss_child(args.rss_child)
+        return 0
+
+    report = run_suite(args.iterations, args.batch, args.workers, not args.no_memory, args.ledger_rows)
+    print_results(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nRésultats enregistrés dans {os.path.abspath(args.output)}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
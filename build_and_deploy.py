@@ -9,6 +9,9 @@ import subprocess
 import sys
 from datetime import datetime
 
+from companion_files import COMPANION_FILES
+
+
 def print_step(step, description):
     """Print a formatted step"""
     print(f"\n{'='*50}")
@@ -44,6 +47,17 @@ def sync_versions():
             print(f"Dossier destination manquant: {os.path.dirname(dest)}")
             success = False
     
+    for module in COMPANION_FILES:
+        for dest in destinations:
+            dest_dir = os.path.dirname(dest)
+            if os.path.exists(dest_dir):
+                try:
+                    shutil.copy2(module, dest_dir)
+                    print(f"Copié {module} vers {dest_dir}")
+                except Exception as e:
+                    print(f"Erreur copie de {module} vers {dest_dir}: {e}")
+                    success = False
+    
     return success
 
 def create_portable_zip():
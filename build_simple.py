@@ -7,6 +7,9 @@ import os
 import zipfile
 import subprocess
 
+from companion_files import COMPANION_FILES
+
+
 def sync_versions():
     """Synchronise toutes les versions"""
     print("ÉTAPE 1: Synchronisation des versions...")
@@ -30,6 +33,17 @@ def sync_versions():
                 print(f"Erreur: {dest} - {e}")
                 return False
     
+    for module in COMPANION_FILES:
+        for dest in destinations:
+            dest_dir = os.path.dirname(dest)
+            if os.path.exists(dest_dir):
+                try:
+                    shutil.copy2(module, dest_dir)
+                    print(f"OK: {dest_dir}/{module}")
+                except Exception as e:
+                    print(f"Erreur: {dest_dir}/{module} - {e}")
+                    return False
+    
     return True
 
 def create_zip():
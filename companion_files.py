@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""
+Files the build and sync scripts copy alongside pdf_filler.py
+"""
+
+# Modules and data files used by pdf_filler.py, copied alongside it
+COMPANION_FILES = [
+    "invoice_cache.py",
+    "invoice_clients.py",
+    "invoice_fields.py",
+    "invoice_ledger.py",
+    "invoice_money.py",
+    "invoice_numbers.py",
+    "invoice_preview.py",
+    "invoice_renderer.py",
+    "invoice_totals.py",
+    "invoice_trace.py",
+    "invoice_layout.json",
+    "apercu_modele.png",
+    "render_server.py",
+]
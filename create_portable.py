@@ -5,6 +5,9 @@ import shutil
 import os
 import zipfile
 
+from companion_files import COMPANION_FILES
+
+
 def create_portable_app():
     # Create portable directory
     portable_dir = "Generateur_Portable"
@@ -15,6 +18,8 @@ def create_portable_app():
     
     # Copy main script
     shutil.copy("pdf_filler.py", os.path.join(portable_dir, "pdf_filler.py"))
+    for module in COMPANION_FILES:
+        shutil.copy(module, os.path.join(portable_dir, module))
     
     # Copy PDF template
     shutil.copy("MODELE FACTURE GLOBAL SOLUTIONS A REMPLIR.pdf", portable_dir)
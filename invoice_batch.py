@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Headless batch rendering of invoices from a CSV or JSON Lines file
+
+Columns / keys are the form field names (numero_de_facture, nom,
+libelle_1, quantite_1, ...). Every record is written to FACTURE_<n>.pdf,
+or with --combined to one page of a single print-run PDF. With
+--numerotation, records without an invoice number get the next one of
+the ledger's sequence; with --calculer, the totals are worked out from
+the lines as in the form, the VAT from each line's rate (taux_tva_1,
+taux_tva_2, ...: 5.5, 10 or 20).
+"""
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+from dataclasses import dataclass
+
+import invoice_ledger
+import invoice_numbers
+import invoice_renderer
+import invoice_totals
+import invoice_trace
+
+
+# Invoice numbers reserved per ledger transaction when numbering a batch
+NUMBER_BLOCK_SIZE = 64
+
+# Records whose totals are computed together, column by column
+TOTALS_CHUNK_SIZE = 1000
+
+
+@dataclass
+class BatchResult:
+    """Outcome of rendering one record"""
+    index: int
+    invoice_number: str
+    output_path: str = None
+    error: str = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def read_records(path):
+    """Read invoice records from a .csv or .jsonl file, in file order
+
+    A JSON line that cannot be parsed is yielded as the ValueError, so it
+    is reported as a failed record instead of aborting the batch.
+    """
+    if path.lower().endswith((".jsonl", ".ndjson", ".json")):
+        with open(path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield ValueError(f"ligne {line_number}: JSON invalide ({e})")
+                    continue
+                if not isinstance(record, dict):
+                    yield ValueError(f"ligne {line_number}: objet JSON {{...}} attendu, pas {line[:40]}")
+                    continue
+                yield record
+        return
+
+    # utf-8-sig and delimiter sniffing cover spreadsheet exports (";" in French locales)
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        for row in csv.DictReader(f, dialect=dialect):
+            yield {key.strip(): value for key, value in row.items() if key}
+
+
+def normalize_record(record):
+    """Turn a raw record into a field mapping of strings"""
+    return {field_name: "" if value is None else str(value) for field_name, value in record.items()}
+
+
+class InvalidTotals(ValueError):
+    """A record whose totals cannot be computed, because fields they come from are not numbers"""
+
+    def __init__(self, record, field_names):
+        super().__init__(invoice_totals.invalid_message(field_names))
+        self.record = record
+
+
+def with_computed_totals(records, chunk_size=TOTALS_CHUNK_SIZE):
+    """Work out the totals of every record from its lines, their VAT rates and the deposit
+
+    Records are read in chunks whose totals are computed a column at a time.
+    A record with a field that is not a number is yielded as an
+    InvalidTotals, so it fails instead of rendering with empty totals.
+    """
+    chunk = []
+    for record in itertools.chain(records, [None]):
+        if record is not None:
+            chunk.append(record)
+            if len(chunk) < chunk_size:
+                continue
+        valid = [normalize_record(record) for record in chunk if isinstance(record, dict)]
+        invalid = []
+        computed = iter(zip(invoice_totals.compute_totals_batch(valid, invalid), invalid))
+        for record in chunk:
+            if isinstance(record, dict):
+                record, field_names = next(computed)
+                if field_names:
+                    record = InvalidTotals(record, field_names)
+            yield record
+        chunk = []
+
+
+def check_record(index, record, duplicate=False):
+    """Validate a record, returning its result and field mapping (None when invalid)"""
+    if isinstance(record, Exception):
+        invoice_number = str(getattr(record, "record", {}).get("numero_de_facture") or "").strip()
+        return BatchResult(index, invoice_number, error=str(record)), None
+    values = normalize_record(record)
+    result = BatchResult(index, values.get("numero_de_facture", "").strip())
+    if not result.invoice_number:
+        result.error = "numéro de facture manquant"
+        return result, None
+    if duplicate:
+        # Two records with the same number would race for the same file
+        result.error = "numéro de facture déjà présent dans le lot"
+        return result, None
+    return result, values
+
+
+def render_record(index, record, output_dir, backend, template_path, duplicate=False, ledger_path=None):
+    """Render one record to disk and record it in the ledger, capturing any failure in the result"""
+    result, values = check_record(index, record, duplicate)
+    if values is None:
+        return result
+    try:
+        with invoice_trace.span("batch.record", index=index):
+            output_path = os.path.join(output_dir, invoice_renderer.output_filename_for(result.invoice_number))
+            result.output_path = invoice_renderer.write_invoice(values, output_path, template_path, backend)
+    except Exception as e:
+        result.error = str(e) or e.__class__.__name__
+        return result
+    if ledger_path:
+        try:
+            invoice_ledger.open_ledger(ledger_path).record(values, result.output_path)
+        except Exception as e:
+            result.error = f"PDF généré mais non enregistré dans le registre: {e}"
+    return result
+
+
+def number_records(records, allocator=None, assigned=None):
+    """Yield (index, record, duplicate) with 1-based indexes in file order
+
+    With an allocator, records without an invoice number get the next
+    one, and assigned maps their index to the number and invoice date.
+    """
+    seen = set()
+    for index, record in enumerate(records, start=1):
+        duplicate = False
+        if isinstance(record, dict):
+            invoice_number = str(record.get("numero_de_facture") or "").strip()
+            if not invoice_number and allocator is not None:
+                day = invoice_numbers.invoice_date(record)
+                invoice_number = allocator.next(day)
+                record = dict(record, numero_de_facture=invoice_number)
+                assigned[index] = (invoice_number, day)
+            duplicate = invoice_number in seen
+            seen.add(invoice_number)
+        yield index, record, duplicate
+
+
+# Per-process settings, set once by the pool initializer
+_worker_options = None
+
+
+def _init_worker(output_dir, backend, template_path, ledger_path):
+    """Warm a pool worker: the PDF stack is imported with this module and the template parsed once"""
+    global _worker_options
+    _worker_options = (output_dir, backend, template_path, ledger_path)
+    invoice_renderer.load_template(template_path)
+    if ledger_path:
+        invoice_ledger.open_ledger(ledger_path)
+
+
+def _render_task(task):
+    index, record, duplicate, queued_at = task
+    if queued_at is not None:
+        invoice_trace.add_complete("batch.queue_wait", queued_at, invoice_trace.now_us(), index=index)
+    output_dir, backend, template_path, ledger_path = _worker_options
+    result = render_record(index, record, output_dir, backend, template_path, duplicate, ledger_path)
+    # Pool workers are terminated, not exited, so their events are written as they go
+    invoice_trace.flush()
+    return result
+
+
+def _queued_tasks(records, allocator, assigned):
+    """Pool tasks, stamped with the time the pool takes them when tracing"""
+    for index, record, duplicate in number_records(records, allocator, assigned):
+        yield index, record, duplicate, invoice_trace.now_us() if invoice_trace.enabled() else None
+
+
+def release_unused_numbers(results, allocator, assigned):
+    """Give back the numbers assigned to records that produced no PDF"""
+    for result in results:
+        if result.output_path is None and result.index in assigned:
+            allocator.release(*assigned[result.index])
+
+
+def run_batch(records, output_dir=".", backend=invoice_renderer.BACKEND_STREAM,
+              template_path=invoice_renderer.TEMPLATE_PATH, workers=1, chunksize=8, ledger_path=None,
+              allocator=None):
+    """Render every record and return the results, in input order
+
+    With workers > 1 the records are spread over a process pool; results
+    still come back in input order and file names only depend on the
+    invoice numbers, so the output is the same as a serial run. Numbers
+    from the allocator are assigned here, in input order, before the
+    records reach the workers.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    assigned = {}
+    if workers <= 1:
+        results = [render_record(index, record, output_dir, backend, template_path, duplicate, ledger_path)
+                   for index, record, duplicate in number_records(records, allocator, assigned)]
+    else:
+        # Workers inherit the trace file, so flush first to keep the parent's events in order
+        invoice_trace.flush()
+        with multiprocessing.Pool(workers, initializer=_init_worker,
+                                  initargs=(output_dir, backend, template_path, ledger_path)) as pool:
+            results = list(pool.imap(_render_task, _queued_tasks(records, allocator, assigned), chunksize))
+    if allocator is not None:
+        release_unused_numbers(results, allocator, assigned)
+    return results
+
+
+def run_combined(records, output_path, template_path=invoice_renderer.TEMPLATE_PATH, ledger_path=None,
+                 allocator=None, backend=invoice_renderer.BACKEND_STREAM):
+    """Render every record as one page of a single PDF and return the results
+
+    Pages are written to the file as they are rendered, so a long print
+    run does not have to fit in memory.
+    """
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    results = []
+    assigned = {}
+    with invoice_renderer.CombinedWriter(output_path, template_path, backend) as combined:
+        for index, record, duplicate in number_records(records, allocator, assigned):
+            result, values = check_record(index, record, duplicate)
+            if values is not None:
+                try:
+                    page_count = combined.add_invoice(values)
+                    first_page = combined.page_count - page_count + 1
+                    if page_count == 1:
+                        result.output_path = f"{output_path} (page {first_page})"
+                    else:
+                        result.output_path = f"{output_path} (pages {first_page}-{combined.page_count})"
+                    if ledger_path:
+                        invoice_ledger.open_ledger(ledger_path).record(values, output_path, content_hash="")
+                except Exception as e:
+                    result.error = str(e) or e.__class__.__name__
+            results.append(result)
+
+    if ledger_path:
+        # Every invoice of the run shares the hash of the combined file
+        invoice_ledger.open_ledger(ledger_path).set_content_hash(output_path, invoice_ledger.file_sha256(output_path))
+    if allocator is not None:
+        release_unused_numbers(results, allocator, assigned)
+    return results
+
+
+def report(results, elapsed):
+    """Print one line per record and the overall throughput"""
+    for result in results:
+        if result.ok:
+            print(f"OK      #{result.index} {result.output_path}")
+        else:
+            print(f"ERREUR  #{result.index} {result.invoice_number or '-'}: {result.error}")
+
+    succeeded = sum(1 for result in results if result.ok)
+    rate = len(results) / elapsed if elapsed > 0 else 0.0
+    print(f"\n{succeeded}/{len(results)} factures générées en {elapsed:.2f} s ({rate:.1f} factures/s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Génère des factures PDF à partir d'un fichier CSV ou JSONL")
+    parser.add_argument("input", help="fichier .csv ou .jsonl, une facture par ligne")
+    parser.add_argument("-o", "--output-dir", default=".", help="dossier de sortie des PDF")
+    parser.add_argument("--backend", choices=invoice_renderer.BACKENDS,
+                        default=invoice_renderer.BACKEND_STREAM, help="moteur de rendu du texte")
+    parser.add_argument("--template", default=invoice_renderer.TEMPLATE_PATH, help="modèle PDF")
+    parser.add_argument("-j", "--workers", type=int, default=1,
+                        help="nombre de processus de rendu (0 = un par cœur)")
+    parser.add_argument("--combined", metavar="FICHIER",
+                        help="écrit toutes les factures dans un seul PDF (rendu dans un seul processus)")
+    parser.add_argument("--registre", default=invoice_ledger.LEDGER_PATH, metavar="FICHIER",
+                        help="registre SQLite où chaque facture générée est enregistrée")
+    parser.add_argument("--sans-registre", action="store_true", help="n'enregistre pas les factures dans le registre")
+    parser.add_argument("--numerotation", nargs="?", const=invoice_numbers.DEFAULT_PATTERN, metavar="MOTIF",
+                        help="numérote les factures sans numéro avec la séquence du registre "
+                             f"(motif par défaut: {invoice_numbers.DEFAULT_PATTERN})")
+    parser.add_argument("--calculer", action="store_true",
+                        help="calcule les totaux des lignes, le total H.T., la TVA par taux (colonnes taux_tva_N), "
+                             "le total T.T.C. et le reste à payer")
+    parser.add_argument("--trace", metavar="FICHIER",
+                        help=f"enregistre une trace Chrome/Perfetto du lot (ou variable {invoice_trace.ENV_VAR})")
+    args = parser.parse_args(argv)
+    if args.trace:
+        invoice_trace.enable(args.trace)
+    workers = args.workers or os.cpu_count() or 1
+
+    # Parse the template up front so its cost is not charged to the first record
+    invoice_renderer.load_template(args.template)
+
+    ledger_path = None if args.sans_registre else args.registre
+    allocator = None
+    if args.numerotation:
+        if ledger_path is None:
+            print("Erreur: --numerotation utilise le registre, incompatible avec --sans-registre")
+            return 1
+        try:
+            allocator = invoice_numbers.InvoiceNumberAllocator(
+                invoice_ledger.open_ledger(ledger_path), args.numerotation, NUMBER_BLOCK_SIZE)
+        except ValueError as e:
+            print(f"Erreur: {e}")
+            return 1
+
+    records = read_records(args.input)
+    if args.calculer:
+        records = with_computed_totals(records)
+
+    start = time.perf_counter()
+    try:
+        if args.combined:
+            results = run_combined(records, args.combined, args.template, ledger_path, allocator, args.backend)
+        else:
+            results = run_batch(records, args.output_dir, args.backend, args.template, workers,
+                                ledger_path=ledger_path, allocator=allocator)
+    finally:
+        if allocator is not None:
+            allocator.close()
+    report(results, time.perf_counter() - start)
+    if invoice_trace.enabled():
+        invoice_trace.flush()
+        print(f"Trace enregistrée dans {invoice_trace.trace_path()}")
+    return 0 if all(result.ok for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Render cache: the PDF of an invoice, stored under a hash of what it was drawn from
+
+The key covers the field values (trimmed, empty fields dropped, in name
+order), the backend, and the fingerprints of the template, the layout
+and the rendering code (the renderer and every module of the application
+it imports), so any change to one of them misses the cache.
+Regenerating an unchanged invoice then returns the stored PDF instead of
+rendering it again.
+
+Entries are files in the cache directory, so they survive a restart.
+The directory is kept under a size limit by evicting the least recently
+used entries; a hit refreshes the file's modification time, which is
+what the eviction order is rebuilt from.
+
+Standard library only, so the GUI can check the cache without loading
+the PDF stack.
+
+Usage: python invoice_cache.py [--vider]
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+from invoice_fields import LAYOUT_PATH, TEMPLATE_PATH
+from invoice_trace import span
+
+CACHE_DIR = os.environ.get(
+    "FACTURES_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache_rendus"),
+)
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+RENDERER_MODULE = "invoice_renderer"
+
+# Total size of the cached PDFs before the least recently used are evicted
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+
+# Bumped when the key layout changes
+KEY_VERSION = 1
+
+_SUFFIX = ".pdf"
+
+
+# File hashes keyed by (path, mtime, size)
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def file_fingerprint(path):
+    """SHA-256 of a file, hashed again only when it changed"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _file_hashes_lock:
+        digest = _file_hashes.get(key)
+    if digest is None:
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with _file_hashes_lock:
+            for stale_key in [k for k in _file_hashes if k[0] == path]:
+                del _file_hashes[stale_key]
+            _file_hashes[key] = digest
+    return digest
+
+
+# Application modules imported by a module, keyed by the hash of its file
+_module_imports = {}
+
+
+def _local_imports(name):
+    """(hash of the module's file, names of the application modules it imports)"""
+    path = os.path.join(APP_DIR, name + ".py")
+    digest = file_fingerprint(path)
+    with _file_hashes_lock:
+        imports = _module_imports.get(digest)
+    if imports is None:
+        with open(path, "rb") as f:
+            tree = ast.parse(f.read(), path)
+        imported = set()
+        for node in ast.walk(tree):
+            # Imports inside functions count too: the renderer is loaded lazily in places
+            if isinstance(node, ast.Import):
+                imported.update(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                imported.add(node.module.split(".")[0])
+        imports = sorted(module for module in imported
+                         if os.path.exists(os.path.join(APP_DIR, module + ".py")))
+        with _file_hashes_lock:
+            _module_imports[digest] = imports
+    return digest, imports
+
+
+def code_fingerprint(module_name=RENDERER_MODULE):
+    """SHA-256 of a module's code and of every application module it imports, directly or not"""
+    digests = {}
+    pending = [module_name]
+    while pending:
+        name = pending.pop()
+        if name not in digests:
+            digests[name], imports = _local_imports(name)
+            pending.extend(imports)
+    digest = hashlib.sha256()
+    for name in sorted(digests):
+        digest.update(f"{name} {digests[name]}\n".encode("ascii"))
+    return digest.hexdigest()
+
+
+def normalize_fields(values):
+    """The fields as the renderer sees them: trimmed strings, empty ones dropped"""
+    normalized = {}
+    for field_name, value in values.items():
+        text = "" if value is None else str(value).strip()
+        if text:
+            normalized[field_name] = text
+    return normalized
+
+
+def render_key(values, backend=None, template_path=TEMPLATE_PATH, layout_path=LAYOUT_PATH):
+    """Cache key of an invoice render"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        "version": KEY_VERSION,
+        "backend": backend or "",
+        "template": file_fingerprint(template_path),
+        "layout": file_fingerprint(layout_path),
+        "renderer": code_fingerprint(RENDERER_MODULE),
+        "fields": normalize_fields(values),
+    }, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """Rendered PDFs on disk, with least-recently-used eviction"""
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._entries = None  # key -> size, least recently used first; read from disk on first use
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def _load(self):
+        """Rebuild the eviction order from the files, oldest first"""
+        if self._entries is not None:
+            return
+        files = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(_SUFFIX) and entry.is_file():
+                        stat = entry.stat()
+                        files.append((stat.st_mtime_ns, entry.name[:-len(_SUFFIX)], stat.st_size))
+        except FileNotFoundError:
+            pass
+        files.sort()
+        self._entries = OrderedDict((key, size) for _, key, size in files)
+        self.total_bytes = sum(self._entries.values())
+
+    def get(self, key):
+        """The cached PDF bytes for key, or None"""
+        with span("render_cache.get"), self.lock:
+            self._load()
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                # Evicted by another process
+                self.total_bytes -= self._entries.pop(key, 0)
+                self.misses += 1
+                return None
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            if key not in self._entries:
+                self._entries[key] = len(data)
+                self.total_bytes += len(data)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """Store the PDF bytes for key, evicting the least recently used entries past the size limit"""
+        if len(data) > self.max_bytes:
+            return
+        with span("render_cache.put", size=len(data)), self.lock:
+            self._load()
+            os.makedirs(self.directory, exist_ok=True)
+            # Write then rename, so a reader never sees a partial PDF
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, self._path(key))
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            self.total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def purge(self):
+        """Delete every cached PDF; returns how many were deleted"""
+        with self.lock:
+            # Rescan, to also catch what other processes added since
+            self._entries = None
+            self._load()
+            count = 0
+            for key in self._entries:
+                try:
+                    os.remove(self._path(key))
+                    count += 1
+                except FileNotFoundError:
+                    pass
+            self._entries.clear()
+            self.total_bytes = 0
+            return count
+
+    def __len__(self):
+        with self.lock:
+            self._load()
+            return len(self._entries)
+
+    def render(self, values, render, backend=None, template_path=TEMPLATE_PATH):
+        """The PDF of an invoice from the cache, or from render(values) stored for next time"""
+        key = render_key(values, backend, template_path)
+        data = self.get(key)
+        if data is None:
+            data = render(values)
+            try:
+                self.put(key, data)
+            except OSError:
+                # Unwritable cache directory: the PDF is rendered all the same
+                pass
+        return data
+
+
+# One cache per directory and process
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def open_cache(directory=CACHE_DIR):
+    """Get this process's cache for a directory"""
+    directory = os.path.abspath(directory)
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = _caches[directory] = RenderCache(directory)
+    return cache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cache des factures déjà rendues")
+    parser.add_argument("--dossier", default=CACHE_DIR, help="dossier du cache")
+    parser.add_argument("--vider", action="store_true", help="supprime toutes les factures du cache")
+    args = parser.parse_args(argv)
+
+    cache = RenderCache(args.dossier)
+    if args.vider:
+        print(f"{cache.purge()} facture(s) supprimée(s) du cache")
+        return 0
+    count = len(cache)
+    print(f"{count} facture(s) en cache, {cache.total_bytes / (1024 * 1024):.1f} Mo "
+          f"(limite {cache.max_bytes / (1024 * 1024):.0f} Mo) dans {args.dossier}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
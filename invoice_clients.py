@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Client directory with prefix autocompletion on the client name
+
+The clients are stored in the ledger (see invoice_ledger). Lookups are
+bisect searches in two in-memory sorted arrays: the names, and each name
+from its second, third... word on, so "dup" also finds "SARL Dupont"
+(after the names starting with "dup"). Keys are folded (case and accents
+ignored) so "societe" finds "Société"; the ledger keys its clients table
+the same way, so both agree on which names are the same client.
+"""
+import bisect
+import threading
+
+from invoice_fields import fold
+from invoice_ledger import CLIENT_FIELDS
+
+
+def _inner_word_suffixes(folded_name):
+    """The name from the start of each of its words after the first"""
+    start = folded_name.find(" ") + 1
+    while start:
+        yield folded_name[start:]
+        start = folded_name.find(" ", start) + 1
+
+
+class ClientDirectory:
+    """Clients by name, with prefix search"""
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Read the whole directory from the ledger and rebuild the index"""
+        clients = {}
+        for client in self.ledger.clients():
+            clients[fold(client["nom"])] = client
+        word_keys = sorted((suffix, name) for name in clients for suffix in _inner_word_suffixes(name))
+        with self.lock:
+            self.clients = clients
+            self.names = sorted(clients)
+            self.word_keys = word_keys  # sorted (name from its second, third... word, name)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def get(self, nom):
+        """The client with this exact name (ignoring case and accents), or None"""
+        return self.clients.get(fold(nom))
+
+    def complete(self, prefix, limit=10):
+        """Up to limit clients whose name, or a word of it, starts with prefix
+
+        Among the hits, names that start with prefix come first.
+        """
+        key = fold(prefix)
+        if not key:
+            return []
+        matches = []
+        with self.lock:
+            names = self.names
+            i = bisect.bisect_left(names, key)
+            while i < len(names) and names[i].startswith(key) and len(matches) < limit:
+                matches.append(names[i])
+                i += 1
+
+            seen = set(matches)
+            word_keys = self.word_keys
+            i = bisect.bisect_left(word_keys, (key,))
+            while i < len(word_keys) and word_keys[i][0].startswith(key) and len(matches) < limit:
+                name = word_keys[i][1]
+                if name not in seen:
+                    seen.add(name)
+                    matches.append(name)
+                i += 1
+            return [self.clients[name] for name in matches]
+
+    def save(self, values):
+        """Add or update a client from its fields, in the ledger and the index"""
+        if self.ledger.save_client(values) is None:
+            return None
+        return self.index(values)
+
+    def index(self, values):
+        """Add or update a client in the index only, e.g. one the ledger just recorded"""
+        client = {field_name: (values.get(field_name) or "").strip() for field_name in CLIENT_FIELDS}
+        if not client["nom"]:
+            return None
+        name = fold(client["nom"])
+        with self.lock:
+            if name not in self.clients:
+                bisect.insort(self.names, name)
+                for suffix in _inner_word_suffixes(name):
+                    bisect.insort(self.word_keys, (suffix, name))
+            self.clients[name] = client
+        return client
+
+    def delete(self, nom):
+        """Remove a client from the directory and the index"""
+        self.ledger.delete_client(nom)
+        name = fold(nom)
+        with self.lock:
+            if self.clients.pop(name, None) is None:
+                return
+            del self.names[bisect.bisect_left(self.names, name)]
+            for suffix in _inner_word_suffixes(name):
+                i = bisect.bisect_left(self.word_keys, (suffix, name))
+                if i < len(self.word_keys) and self.word_keys[i] == (suffix, name):
+                    del self.word_keys[i]
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Invoice field helpers shared by the GUI, the renderer and batch tools
+
+Standard library only, so the GUI can use it without loading the PDF stack.
+"""
+import os
+import unicodedata
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+TEMPLATE_NAME = "MODELE FACTURE GLOBAL SOLUTIONS A REMPLIR.pdf"
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), TEMPLATE_NAME)
+LAYOUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "invoice_layout.json")
+
+# Amounts are below 10**16 with at most 15 decimals, so exact arithmetic on them stays cheap
+AMOUNT_DIGITS = 15
+
+
+def output_filename_for(invoice_number):
+    """Get the output file name for an invoice number"""
+    invoice_number = (invoice_number or "").strip()
+    if invoice_number:
+        return f"FACTURE_{invoice_number}.pdf"
+    return "FACTURE_SANS_NUMERO.pdf"
+
+
+def fold(text):
+    """Case- and accent-insensitive form of a name, for matching"""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(stripped.casefold().split())
+
+
+def parse_amount(text):
+    """Parse an amount typed as "1234.50 €" or "1234,50"; None when it is not a number or out of range"""
+    text = str(text or "").replace("€", "").replace(" ", "").replace(",", ".")
+    if not text:
+        return Decimal(0)
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        return None
+    # "nan" and "inf" parse, but are not amounts; nor is "1e500000", whose digits would take seconds to build
+    if not amount.is_finite() or abs(amount.adjusted()) > AMOUNT_DIGITS or amount.as_tuple().exponent < -AMOUNT_DIGITS:
+        return None
+    return amount
+
+
+def parse_date(text):
+    """Parse a date typed as 18/10/2026 (or 2026-10-18) into a date; None when it is not a date"""
+    text = (text or "").strip()
+    for date_format in ("%d/%m/%Y", "%d/%m/%y", "%Y-%m-%d", "%d-%m-%Y", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            pass
+    return None
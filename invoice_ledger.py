@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""
+Invoice ledger: a local SQLite database with one row per generated invoice
+
+Every invoice written by the GUI or the batch tool is recorded with all
+its form fields, its totals, the output path and the SHA-256 of the PDF.
+Regenerating an invoice number updates its row, the same way the PDF
+file is overwritten. Lookups by number, client, date and amount are
+indexed, and the database runs in WAL mode so searches never block a
+render that is recording an invoice.
+
+A full-text index (SQLite FTS5) over the line item labels, the place of
+work, the document reference and the special notes is kept up to date
+with every recorded invoice, for ranked free-text search.
+
+The clients table is the client directory: the client fields of the
+latest invoice for each client name, which can also be edited directly.
+Clients are keyed by their folded name (case and accents ignored), as
+in invoice_clients.
+
+The invoice_sequences and released_numbers tables hold the invoice
+number sequences handed out by invoice_numbers.
+
+Usage: python invoice_ledger.py [--client DUPONT] [--du 01/07/2026] [--au 30/09/2026]
+       python invoice_ledger.py --recherche "ravalement façade montreuil"
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+
+import invoice_money
+from invoice_fields import fold, parse_amount, parse_date
+
+LEDGER_PATH = os.environ.get(
+    "FACTURES_LEDGER",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "registre_factures.db"),
+)
+
+SCHEMA_VERSION = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    id INTEGER PRIMARY KEY,
+    numero TEXT NOT NULL,
+    client TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+    invoice_date TEXT,
+    total_ht_cents INTEGER,
+    total_ttc_cents INTEGER,
+    amount_cents INTEGER,
+    output_path TEXT,
+    content_hash TEXT,
+    fields TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS invoices_numero ON invoices (numero);
+CREATE INDEX IF NOT EXISTS invoices_client_date ON invoices (client, invoice_date);
+CREATE INDEX IF NOT EXISTS invoices_date ON invoices (invoice_date);
+CREATE INDEX IF NOT EXISTS invoices_amount ON invoices (amount_cents);
+CREATE TABLE IF NOT EXISTS clients (
+    cle TEXT PRIMARY KEY,
+    nom TEXT NOT NULL,
+    adresse TEXT NOT NULL DEFAULT '',
+    ville TEXT NOT NULL DEFAULT '',
+    num_rc TEXT NOT NULL DEFAULT '',
+    tva TEXT NOT NULL DEFAULT '',
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS invoice_sequences (
+    name TEXT PRIMARY KEY,
+    next_value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS released_numbers (
+    name TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (name, value)
+);
+"""
+
+CLIENT_FIELDS = ("nom", "adresse", "ville", "num_rc", "tva")
+
+# Full-text index, one row per invoice with rowid = invoices.id. Accents and
+# case are ignored, so "facade" finds "Façade".
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE invoices_fts USING fts5(
+    libelles, lieu_d_intervention, document, additions_speciales,
+    tokenize = 'unicode61 remove_diacritics 2'
+)
+"""
+
+# Relevance weight of each indexed column, in FTS_SCHEMA order
+FTS_WEIGHTS = (1.0, 2.0, 2.0, 0.5)
+
+# Columns returned by find()
+COLUMNS = ("id", "numero", "client", "invoice_date", "total_ht_cents", "total_ttc_cents",
+           "amount_cents", "output_path", "content_hash", "created_at", "updated_at")
+
+
+def to_cents(text):
+    """Amount field as integer cents, or None when empty or not a number"""
+    if not str(text or "").strip():
+        return None
+    amount = parse_amount(text)
+    if amount is None:
+        return None
+    return invoice_money.to_cents(amount)
+
+
+def file_sha256(path):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def search_columns(values):
+    """Text of each full-text column for a field mapping"""
+    labels = []
+    for field_name, value in values.items():
+        column, _, index = field_name.rpartition("_")
+        if column == "libelle" and index.isdigit() and value:
+            labels.append((int(index), value))
+    return (
+        "\n".join(value for _, value in sorted(labels)),
+        values.get("lieu_d_intervention") or "",
+        values.get("document") or "",
+        values.get("additions_speciales") or "",
+    )
+
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _iso_date(value):
+    """A date given as text or date object, as an ISO string for comparisons"""
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    parsed = parse_date(value)
+    if parsed is None:
+        raise ValueError(f"date invalide: {value}")
+    return parsed.isoformat()
+
+
+class InvoiceLedger:
+    """Connection to the ledger database"""
+
+    def __init__(self, path=LEDGER_PATH):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        # Readers never block the writer and vice versa; NORMAL is durable enough under WAL
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                if 2 <= version < 4:
+                    # Clients were keyed by nom COLLATE NOCASE, which keeps the accents
+                    self.connection.execute("ALTER TABLE clients RENAME TO clients_v3")
+                self.connection.executescript(SCHEMA)
+                if version < 2:
+                    # Build the client directory from the invoices recorded so far, oldest first
+                    for (fields,) in self.connection.execute(
+                            "SELECT fields FROM invoices ORDER BY updated_at, id").fetchall():
+                        self._save_client(json.loads(fields))
+                elif version < 4:
+                    # Re-key them by folded name; of names that fold alike, the latest edited wins
+                    for row in self.connection.execute(
+                            f"SELECT {', '.join(CLIENT_FIELDS)}, updated_at FROM clients_v3 "
+                            "ORDER BY updated_at").fetchall():
+                        self._save_client(dict(row), row["updated_at"])
+                    self.connection.execute("DROP TABLE clients_v3")
+                self.connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            self.has_fts = self._create_fts()
+
+    def _create_fts(self):
+        """Create and fill the full-text index if needed; False when SQLite has no FTS5"""
+        exists = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'invoices_fts'").fetchone()
+        if exists:
+            return True
+        try:
+            self.connection.execute(FTS_SCHEMA)
+        except sqlite3.OperationalError:
+            return False
+        # Index invoices recorded before the index existed
+        for invoice_id, fields in self.connection.execute("SELECT id, fields FROM invoices").fetchall():
+            self._index(invoice_id, json.loads(fields))
+        return True
+
+    def _index(self, invoice_id, values):
+        self.connection.execute("DELETE FROM invoices_fts WHERE rowid = ?", (invoice_id,))
+        self.connection.execute(
+            "INSERT INTO invoices_fts (rowid, libelles, lieu_d_intervention, document, additions_speciales) "
+            "VALUES (?, ?, ?, ?, ?)", (invoice_id,) + search_columns(values))
+
+    def record(self, values, output_path=None, content_hash=None):
+        """Record a generated invoice, replacing any earlier row with the same number"""
+        numero = (values.get("numero_de_facture") or "").strip()
+        if not numero:
+            raise ValueError("numéro de facture manquant")
+        if content_hash is None and output_path and os.path.exists(output_path):
+            content_hash = file_sha256(output_path)
+
+        invoice_date = parse_date(values.get("date"))
+        total_ht = to_cents(values.get("total_hors_taxe"))
+        total_ttc = to_cents(values.get("total_net_de_taxes"))
+        now = datetime.now().isoformat(timespec="seconds")
+        row = {
+            "numero": numero,
+            "client": (values.get("nom") or "").strip(),
+            "invoice_date": invoice_date.isoformat() if invoice_date else None,
+            "total_ht_cents": total_ht,
+            "total_ttc_cents": total_ttc,
+            # The amount searched on is the total with taxes, or without when there is none
+            "amount_cents": total_ttc if total_ttc is not None else total_ht,
+            "output_path": os.path.abspath(output_path) if output_path else None,
+            "content_hash": content_hash,
+            "fields": json.dumps(values, ensure_ascii=False),
+            "now": now,
+        }
+        with self.lock, self.connection:
+            self.connection.execute(
+                """
+                INSERT INTO invoices (numero, client, invoice_date, total_ht_cents, total_ttc_cents,
+                                      amount_cents, output_path, content_hash, fields, created_at, updated_at)
+                VALUES (:numero, :client, :invoice_date, :total_ht_cents, :total_ttc_cents,
+                        :amount_cents, :output_path, :content_hash, :fields, :now, :now)
+                ON CONFLICT (numero) DO UPDATE SET
+                    client = excluded.client, invoice_date = excluded.invoice_date,
+                    total_ht_cents = excluded.total_ht_cents, total_ttc_cents = excluded.total_ttc_cents,
+                    amount_cents = excluded.amount_cents, output_path = excluded.output_path,
+                    content_hash = excluded.content_hash, fields = excluded.fields,
+                    updated_at = excluded.updated_at
+                """,
+                row,
+            )
+            invoice_id = self.connection.execute("SELECT id FROM invoices WHERE numero = ?", (numero,)).fetchone()[0]
+            if self.has_fts:
+                self._index(invoice_id, values)
+            self._save_client(values)
+            return invoice_id
+
+    def get(self, numero):
+        """The ledger row for an invoice number, with its fields, or None"""
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM invoices WHERE numero = ?", (numero,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry["fields"] = json.loads(entry["fields"])
+        return entry
+
+    def find(self, client=None, date_from=None, date_to=None, min_amount=None, max_amount=None, limit=100):
+        """Invoices matching every given criterion, most recent first
+
+        client matches the start of the client name, ignoring case. Dates
+        are inclusive and amounts are in euros (text or numbers).
+        """
+        conditions = []
+        params = []
+        # With a client, (client, invoice_date) is the selective index; the unary +
+        # keeps the planner from preferring the date-only index when it has no statistics
+        date_column = "invoice_date"
+        if client:
+            conditions.append("client LIKE ? ESCAPE '\\'")
+            params.append(_escape_like(client.strip()) + "%")
+            date_column = "+invoice_date"
+        if date_from is not None:
+            conditions.append(f"{date_column} >= ?")
+            params.append(_iso_date(date_from))
+        if date_to is not None:
+            conditions.append(f"{date_column} <= ?")
+            params.append(_iso_date(date_to))
+        if min_amount is not None:
+            conditions.append("amount_cents >= ?")
+            params.append(to_cents(min_amount))
+        if max_amount is not None:
+            conditions.append("amount_cents <= ?")
+            params.append(to_cents(max_amount))
+
+        query = f"SELECT {', '.join(COLUMNS)} FROM invoices"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY invoice_date DESC, id DESC LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(query, params)]
+
+    def _save_client(self, values, updated_at=None):
+        client = {field_name: (values.get(field_name) or "").strip() for field_name in CLIENT_FIELDS}
+        cle = fold(client["nom"])
+        if not cle:
+            return None
+        row = dict(client, cle=cle, updated_at=updated_at or datetime.now().isoformat(timespec="seconds"))
+        self.connection.execute(
+            """
+            INSERT INTO clients (cle, nom, adresse, ville, num_rc, tva, updated_at)
+            VALUES (:cle, :nom, :adresse, :ville, :num_rc, :tva, :updated_at)
+            ON CONFLICT (cle) DO UPDATE SET
+                nom = excluded.nom, adresse = excluded.adresse, ville = excluded.ville,
+                num_rc = excluded.num_rc, tva = excluded.tva, updated_at = excluded.updated_at
+            """,
+            row,
+        )
+        return client
+
+    def save_client(self, values):
+        """Add or update a client of the directory from its fields; returns the saved client"""
+        with self.lock, self.connection:
+            return self._save_client(values)
+
+    def delete_client(self, nom):
+        """Remove a client from the directory"""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM clients WHERE cle = ?", (fold(nom),))
+
+    def clients(self):
+        """Every client of the directory"""
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(
+                f"SELECT {', '.join(CLIENT_FIELDS)} FROM clients")]
+
+    def numeros_starting_with(self, prefix):
+        """Every recorded invoice number that starts with prefix"""
+        with self.lock:
+            return [numero for (numero,) in self.connection.execute(
+                "SELECT numero FROM invoices WHERE numero >= ? AND numero < ?", (prefix, prefix + "\uffff"))]
+
+    def has_sequence(self, sequence):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT 1 FROM invoice_sequences WHERE name = ?", (sequence,)).fetchone() is not None
+
+    def reserve_numbers(self, sequence, count, first_value=1):
+        """Take count values of a number sequence, atomically across threads and processes
+
+        sequence is the number format with an {n} field, e.g. "2026-{n:04d}";
+        a new sequence starts at first_value. Released values are handed out
+        again first, lowest first, and values whose number was already
+        recorded (typed by hand) are skipped.
+        """
+        values = []
+        with self.lock:
+            # IMMEDIATE takes the write lock before reading the counter, so no two processes read the same value
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    "SELECT next_value FROM invoice_sequences WHERE name = ?", (sequence,)).fetchone()
+                next_value = row[0] if row else first_value
+                released = [value for (value,) in self.connection.execute(
+                    "SELECT value FROM released_numbers WHERE name = ? ORDER BY value LIMIT ?", (sequence, count))]
+                for value in released:
+                    self.connection.execute(
+                        "DELETE FROM released_numbers WHERE name = ? AND value = ?", (sequence, value))
+                    if not self._numero_taken(sequence.format(n=value)):
+                        values.append(value)
+                while len(values) < count:
+                    if not self._numero_taken(sequence.format(n=next_value)):
+                        values.append(next_value)
+                    next_value += 1
+                self.connection.execute(
+                    "INSERT INTO invoice_sequences (name, next_value) VALUES (?, ?) "
+                    "ON CONFLICT (name) DO UPDATE SET next_value = excluded.next_value", (sequence, next_value))
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+        return values
+
+    def peek_numbers(self, sequence, count, first_value=1):
+        """The values reserve_numbers() would hand out now, without taking them"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT next_value FROM invoice_sequences WHERE name = ?", (sequence,)).fetchone()
+            next_value = row[0] if row else first_value
+            values = [value for (value,) in self.connection.execute(
+                "SELECT value FROM released_numbers WHERE name = ? ORDER BY value LIMIT ?", (sequence, count))
+                if not self._numero_taken(sequence.format(n=value))]
+            while len(values) < count:
+                if not self._numero_taken(sequence.format(n=next_value)):
+                    values.append(next_value)
+                next_value += 1
+        return values
+
+    def release_numbers(self, sequence, values):
+        """Give back reserved values that were not used, so the sequence has no gaps"""
+        if not values:
+            return
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO released_numbers (name, value) VALUES (?, ?)",
+                    [(sequence, value) for value in values])
+                # Values at the top of the sequence just move the counter back
+                next_value = self.connection.execute(
+                    "SELECT next_value FROM invoice_sequences WHERE name = ?", (sequence,)).fetchone()[0]
+                while self.connection.execute(
+                        "DELETE FROM released_numbers WHERE name = ? AND value = ?",
+                        (sequence, next_value - 1)).rowcount:
+                    next_value -= 1
+                self.connection.execute(
+                    "UPDATE invoice_sequences SET next_value = ? WHERE name = ?", (next_value, sequence))
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+
+    def _numero_taken(self, numero):
+        return self.connection.execute("SELECT 1 FROM invoices WHERE numero = ?", (numero,)).fetchone() is not None
+
+    def search(self, query, limit=20):
+        """Invoices whose labels, place, document or notes contain every word of query, best first
+
+        Words match as prefixes ("raval" finds "ravalement"). Each hit has
+        the find() columns plus "extrait", the matching text with the words
+        in [brackets].
+        """
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        columns = ", ".join(f"i.{column}" for column in COLUMNS)
+        if not self.has_fts:
+            # No FTS5 in this SQLite: scan the stored fields instead
+            conditions = " AND ".join("i.fields LIKE ? ESCAPE '\\'" for _ in words)
+            params = [f"%{_escape_like(word)}%" for word in words] + [limit]
+            sql = (f"SELECT {columns}, '' AS extrait FROM invoices i WHERE {conditions} "
+                   f"ORDER BY i.updated_at DESC LIMIT ?")
+        else:
+            params = [" ".join(f'"{word}"*' for word in words), limit]
+            weights = ", ".join(str(weight) for weight in FTS_WEIGHTS)
+            sql = (f"SELECT {columns}, snippet(invoices_fts, -1, '[', ']', '…', 10) AS extrait "
+                   f"FROM invoices_fts JOIN invoices i ON i.id = invoices_fts.rowid "
+                   f"WHERE invoices_fts MATCH ? ORDER BY bm25(invoices_fts, {weights}) LIMIT ?")
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(sql, params)]
+
+    def set_content_hash(self, output_path, content_hash):
+        """Set the hash of every invoice written to output_path (a combined print run)"""
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE invoices SET content_hash = ? WHERE output_path = ?",
+                                    (content_hash, os.path.abspath(output_path)))
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# One connection per ledger file and process (connections must not cross a fork)
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def open_ledger(path=LEDGER_PATH):
+    """Get this process's connection to a ledger, opening it on first use"""
+    key = (os.path.abspath(path), os.getpid())
+    with _ledgers_lock:
+        ledger = _ledgers.get(key)
+        if ledger is None:
+            ledger = _ledgers[key] = InvoiceLedger(path)
+    return ledger
+
+
+def format_cents(cents):
+    return "" if cents is None else invoice_money.format_money(cents)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recherche dans le registre des factures")
+    parser.add_argument("--registre", default=LEDGER_PATH, help="base de données du registre")
+    parser.add_argument("--numero", help="numéro de facture exact")
+    parser.add_argument("--recherche", help="mots à chercher dans les libellés, le lieu, le document et les notes")
+    parser.add_argument("--client", help="début du nom du client")
+    parser.add_argument("--du", dest="date_from", help="date minimale (JJ/MM/AAAA)")
+    parser.add_argument("--au", dest="date_to", help="date maximale (JJ/MM/AAAA)")
+    parser.add_argument("--min", dest="min_amount", help="montant TTC minimal")
+    parser.add_argument("--max", dest="max_amount", help="montant TTC maximal")
+    parser.add_argument("-n", "--limit", type=int, default=100, help="nombre maximal de résultats")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.registre):
+        print(f"Registre introuvable: {args.registre}")
+        return 1
+    ledger = InvoiceLedger(args.registre)
+    try:
+        if args.numero:
+            entry = ledger.get(args.numero)
+            rows = [entry] if entry else []
+        elif args.recherche:
+            rows = ledger.search(args.recherche, args.limit)
+        else:
+            rows = ledger.find(args.client, args.date_from, args.date_to,
+                               args.min_amount, args.max_amount, args.limit)
+    except ValueError as e:
+        print(f"Erreur: {e}")
+        return 1
+
+    for row in rows:
+        print(f"{row['numero']:<15} {row['invoice_date'] or '':<10} {row['client'][:30]:<30} "
+              f"{format_cents(row['amount_cents']):>14}  {row['output_path'] or ''}")
+        if row.get("extrait"):
+            print(f"    {' '.join(row['extrait'].split())}")
+    print(f"\n{len(rows)} facture(s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
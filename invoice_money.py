@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Exact money arithmetic in integer cents
+
+Amounts are typed as text, parsed into Decimal (never float), and every
+amount of money is held as an int number of cents. Rounding happens at
+fixed points only, always half away from zero (0.125 -> 0.13,
+-0.125 -> -0.13), as on a paper invoice:
+
+- a line total is quantity x unit price, rounded to the cent; unit
+  prices and quantities keep every decimal typed;
+- an amount typed with more than two decimals is rounded to the cent;
+- the total H.T. is the sum of the rounded line totals;
+- the VAT of each rate is computed once on the sum of the line totals
+  at that rate, and rounded to the cent;
+- the T.T.C. and the balance are sums and differences of cents, so they
+  are exact.
+
+The rounding itself is integer arithmetic on (numerator, exponent)
+pairs, so the form, the batch path over columns and the renderer all
+round the same way. Standard library only.
+"""
+from decimal import Decimal
+
+from invoice_fields import parse_amount
+
+_POWERS_OF_TEN = [10 ** exponent for exponent in range(64)]
+
+
+def scaled(amount):
+    """A finite Decimal as (numerator, exponent), amount == numerator / 10**exponent"""
+    exponent = amount.as_tuple().exponent
+    if exponent >= 0:
+        return int(amount), 0
+    return int(amount.scaleb(-exponent)), -exponent
+
+
+def _power_of_ten(exponent):
+    if exponent < len(_POWERS_OF_TEN):
+        return _POWERS_OF_TEN[exponent]
+    return 10 ** exponent
+
+
+def round_half_up(numerator, denominator):
+    """numerator / denominator rounded to an int, halves away from zero (denominator > 0)"""
+    quotient, remainder = divmod(abs(numerator), denominator)
+    if 2 * remainder >= denominator:
+        quotient += 1
+    return quotient if numerator >= 0 else -quotient
+
+
+def to_cents(amount):
+    """A Decimal amount in cents"""
+    numerator, exponent = scaled(amount)
+    if exponent <= 2:
+        return numerator * _POWERS_OF_TEN[2 - exponent]
+    return round_half_up(numerator, _power_of_ten(exponent - 2))
+
+
+def scaled_line_cents(quantity, unit_price):
+    """Line total in cents from a scaled quantity and unit price"""
+    return round_half_up(quantity[0] * unit_price[0] * 100, _power_of_ten(quantity[1] + unit_price[1]))
+
+
+def line_cents(quantity, unit_price):
+    """Quantity x unit price (Decimals), rounded to the cent"""
+    return scaled_line_cents(scaled(quantity), scaled(unit_price))
+
+
+def vat_cents(base_cents, rate):
+    """VAT in cents on a base in cents, at a rate in percent (a Decimal such as 5.5)"""
+    numerator, exponent = scaled(rate)
+    return round_half_up(base_cents * numerator, 100 * _power_of_ten(exponent))
+
+
+def parse_cents(text):
+    """A typed amount in cents (0 when empty); None when it is not a number"""
+    amount = parse_amount(text)
+    return None if amount is None else to_cents(amount)
+
+
+def cents_text(cents):
+    """Cents as "1234.50" """
+    return str(Decimal(cents).scaleb(-2))
+
+
+def format_money(cents):
+    """Cents as "1234.50 €" """
+    return f"{cents_text(cents)} €"
+
+
+def _typed_amount(text):
+    text = str(text or "").strip()
+    if not text or text == "0":
+        return None
+    return parse_amount(text)
+
+
+def money_text(text):
+    """A typed amount rewritten as "1234.50 €"; None when empty, zero or not a number"""
+    amount = _typed_amount(text)
+    return None if amount is None else format_money(to_cents(amount))
+
+
+def price_text(text):
+    """A typed unit price rewritten as "12.50 €", keeping any decimals past the cent"""
+    amount = _typed_amount(text)
+    if amount is None:
+        return None
+    normalized = amount.normalize()
+    if normalized.as_tuple().exponent < -2:
+        return f"{normalized:f} €"
+    return format_money(to_cents(amount))
+
+
+def whole_euros_text(text):
+    """A typed amount rounded to the euro, as "1234,00 €"; None when empty, zero or not a number"""
+    amount = _typed_amount(text)
+    if amount is None:
+        return None
+    return f"{round_half_up(to_cents(amount), 100)},00 €"
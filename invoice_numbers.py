@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Invoice number allocation
+
+Numbers follow a pattern such as "{annee}-{n:04d}" (2026-0001, 2026-0002,
+...): {n} is the sequence value and {annee} / {mois} the year and month of
+the invoice date, so each year (or month) has its own sequence starting
+at 1, or after the highest matching number already in the ledger.
+
+Sequences are stored in the ledger and taken in an IMMEDIATE
+transaction, so two windows or two batch processes never get the same
+number. A number that ends up unused (its PDF could not be written) is
+released and handed out again first, which keeps the numbering free of
+gaps. A batch reserves numbers by blocks of block_size instead of one
+transaction per invoice; close() releases what is left of its blocks.
+
+From the command line the next numbers are only shown; --reserver takes
+them for good, for invoices made outside this application.
+
+Usage: python invoice_numbers.py [--motif "{annee}-{n:04d}"] [--date 01/07/2026] [-n 3] [--reserver]
+"""
+import argparse
+import re
+import string
+import sys
+import threading
+from collections import deque
+from dataclasses import dataclass
+from datetime import date
+
+import invoice_ledger
+from invoice_fields import parse_date
+
+DEFAULT_PATTERN = "{annee}-{n:04d}"
+
+
+@dataclass(frozen=True)
+class NumberSequence:
+    """The numbers of one pattern for one period"""
+    name: str  # number format with only the {n} field left, e.g. "2026-{n:04d}"
+    regex: str  # matches a number of the sequence, with the value as group 1
+
+    def format(self, value):
+        return self.name.format(n=value)
+
+    def parse(self, numero):
+        """The sequence value of a number, or None when it is not from this sequence"""
+        match = re.fullmatch(self.regex, (numero or "").strip())
+        return int(match.group(1)) if match else None
+
+    @property
+    def prefix(self):
+        """Text every number of the sequence starts with"""
+        return self.name.split("{n", 1)[0].replace("{{", "{").replace("}}", "}")
+
+
+def sequence_for(pattern, day):
+    """The sequence of pattern that numbers invoices dated day"""
+    name = []
+    regex = []
+    has_value = False
+    try:
+        parts = list(string.Formatter().parse(pattern))
+    except ValueError as e:
+        raise ValueError(f"motif de numérotation invalide: {e}") from None
+    for literal, field_name, spec, conversion in parts:
+        name.append(literal.replace("{", "{{").replace("}", "}}"))
+        regex.append(re.escape(literal))
+        if field_name is None:
+            continue
+        if field_name == "n":
+            if has_value:
+                raise ValueError("motif de numérotation invalide: {n} apparaît deux fois")
+            has_value = True
+            name.append("{n:" + spec + "}" if spec else "{n}")
+            regex.append(r"0*(\d+)" if spec else r"(\d+)")
+        elif field_name in ("annee", "mois"):
+            value = day.year if field_name == "annee" else day.month
+            text = format(value, spec or ("02" if field_name == "mois" else ""))
+            name.append(text.replace("{", "{{").replace("}", "}}"))
+            regex.append(re.escape(text))
+        else:
+            raise ValueError(f"motif de numérotation invalide: champ {{{field_name}}} inconnu")
+    if not has_value:
+        raise ValueError("motif de numérotation invalide: il manque {n}")
+    return NumberSequence("".join(name), "".join(regex))
+
+
+class InvoiceNumberAllocator:
+    """Hands out invoice numbers from the ledger's sequences"""
+
+    def __init__(self, ledger, pattern=DEFAULT_PATTERN, block_size=1):
+        sequence_for(pattern, date.today())  # reject a bad pattern up front
+        self.ledger = ledger
+        self.pattern = pattern
+        self.block_size = max(1, block_size)
+        self.blocks = {}  # sequence name -> reserved values not handed out yet, lowest first
+        self.lock = threading.Lock()
+
+    def sequence(self, day=None):
+        return sequence_for(self.pattern, day or date.today())
+
+    def next(self, day=None):
+        """The next number for an invoice dated day (today by default)"""
+        sequence = self.sequence(day)
+        with self.lock:
+            block = self.blocks.setdefault(sequence.name, deque())
+            if not block:
+                block.extend(self.ledger.reserve_numbers(
+                    sequence.name, self.block_size, self._first_value(sequence)))
+            return sequence.format(block.popleft())
+
+    def peek(self, count=1, day=None):
+        """The next count numbers for invoices dated day, without reserving them"""
+        sequence = self.sequence(day)
+        values = self.ledger.peek_numbers(sequence.name, count, self._first_value(sequence))
+        return [sequence.format(value) for value in values]
+
+    def _first_value(self, sequence):
+        """Where a new sequence starts: after the highest number of it already recorded"""
+        if self.ledger.has_sequence(sequence.name):
+            return 1
+        values = [sequence.parse(numero) for numero in self.ledger.numeros_starting_with(sequence.prefix)]
+        return max((value for value in values if value is not None), default=0) + 1
+
+    def release(self, numero, day=None):
+        """Give back a number that was not used; False when it is not from this pattern"""
+        sequence = self.sequence(day)
+        value = sequence.parse(numero)
+        if value is None or sequence.format(value) != numero.strip():
+            return False
+        self.ledger.release_numbers(sequence.name, [value])
+        return True
+
+    def close(self):
+        """Release the numbers reserved but not handed out"""
+        with self.lock:
+            blocks, self.blocks = self.blocks, {}
+        for name, block in blocks.items():
+            self.ledger.release_numbers(name, list(block))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def invoice_date(values):
+    """The date of an invoice from its fields, today when missing or unreadable"""
+    return parse_date(values.get("date")) or date.today()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Affiche ou attribue les prochains numéros de facture")
+    parser.add_argument("--registre", default=invoice_ledger.LEDGER_PATH, help="base de données du registre")
+    parser.add_argument("--motif", default=DEFAULT_PATTERN,
+                        help="motif des numéros: {annee}, {mois} et {n} (défaut: %(default)s)")
+    parser.add_argument("--date", help="date des factures (JJ/MM/AAAA, aujourd'hui par défaut)")
+    parser.add_argument("-n", "--nombre", type=int, default=1, help="nombre de numéros")
+    parser.add_argument("--reserver", action="store_true",
+                        help="réserve les numéros pour de bon (sinon ils sont seulement affichés)")
+    args = parser.parse_args(argv)
+
+    day = date.today()
+    if args.date:
+        day = parse_date(args.date)
+        if day is None:
+            print(f"Erreur: date invalide: {args.date}")
+            return 1
+    try:
+        with InvoiceNumberAllocator(invoice_ledger.InvoiceLedger(args.registre), args.motif, args.nombre) as allocator:
+            if not args.reserver:
+                for numero in allocator.peek(args.nombre, day):
+                    print(numero)
+                return 0
+            for _ in range(args.nombre):
+                print(allocator.next(day))
+    except ValueError as e:
+        print(f"Erreur: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
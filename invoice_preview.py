@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Live preview of the first page of the invoice, drawn in the form window
+
+The preview replays the renderer's draw operations as Tk canvas text over
+a low-resolution image of the template, at PREVIEW_SCALE. Field edits
+only schedule a redraw; the redraw runs once per idle cycle and only
+replaces the text of the fields whose value on the page changed.
+
+The template image is rendered with PyMuPDF when it is installed, and
+cached under the template's fingerprint; otherwise the image shipped
+with the application (drawn from the default template) is used.
+"""
+import os
+import tkinter as tk
+from tkinter import ttk
+
+import invoice_cache
+from invoice_fields import TEMPLATE_PATH
+
+PREVIEW_SCALE = 0.75
+TEMPLATE_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "apercu_modele.png")
+
+# Distance from the baseline to the bottom of the text box, in font sizes
+_DESCENT = 0.22
+
+
+def template_image(template_path=TEMPLATE_PATH, cache_dir=invoice_cache.CACHE_DIR):
+    """Path of a PNG of the template page at preview scale, or None"""
+    fingerprint = invoice_cache.file_fingerprint(template_path)[:16]
+    cached = os.path.join(cache_dir, f"modele_{fingerprint}.png")
+    if os.path.exists(cached):
+        return cached
+    try:
+        import pymupdf
+    except ImportError:
+        try:
+            import fitz as pymupdf  # older PyMuPDF releases
+        except ImportError:
+            pymupdf = None
+    if pymupdf is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with pymupdf.open(template_path) as document:
+                matrix = pymupdf.Matrix(PREVIEW_SCALE, PREVIEW_SCALE)
+                document[0].get_pixmap(matrix=matrix).save(cached)
+            return cached
+        except Exception:
+            pass
+    if os.path.exists(TEMPLATE_IMAGE):
+        return TEMPLATE_IMAGE
+    return None
+
+
+def _tk_font(op):
+    size = -max(1, round(op.font_size * PREVIEW_SCALE))  # negative: pixels
+    style = []
+    if "Bold" in op.font_name:
+        style.append("bold")
+    if "Oblique" in op.font_name or "Italic" in op.font_name:
+        style.append("italic")
+    return (op.font_name.split("-")[0], size) + tuple(style)
+
+
+def _tk_color(color):
+    return "#" + "".join(f"{round(component * 255):02x}" for component in color)
+
+
+class InvoicePreview:
+    """Preview pane showing the invoice as the fields are typed"""
+
+    def __init__(self, app, parent):
+        # The PDF stack is only loaded once the preview is opened
+        import invoice_renderer
+        self.renderer = invoice_renderer
+        self.app = app
+        self.template = invoice_renderer.load_template()
+        llx, lly, urx, ury = [float(x) for x in self.template.media_box]
+        self.left = llx
+        self.top = ury
+
+        self.frame = ttk.LabelFrame(parent, text="Aperçu (page 1)", padding=4)
+        width = round(self.template.width * PREVIEW_SCALE)
+        height = round(self.template.height * PREVIEW_SCALE)
+        self.canvas = tk.Canvas(self.frame, width=width, height=height, bg="white", highlightthickness=0)
+        self.canvas.pack()
+        self.image = None
+        image_path = template_image()
+        if image_path:
+            try:
+                self.image = tk.PhotoImage(file=image_path)
+                self.canvas.create_image(0, 0, image=self.image, anchor="nw")
+            except tk.TclError:
+                # No PNG support in this Tk: text only
+                self.image = None
+
+        self.items = {}  # field name -> canvas items
+        self.shown = {}  # field name -> value drawn
+        self.layout_fingerprint = None
+        self.scheduled = False
+        self.visible = False
+        self.watched = set()
+        self.watch_new_fields()
+
+    def watch_new_fields(self):
+        """Redraw on edits of fields added since the last call (new line items)"""
+        for field_name, var in self.app.fields.items():
+            if field_name in self.watched:
+                continue
+            self.watched.add(field_name)
+            if hasattr(var, "trace_add"):
+                var.trace_add("write", self.schedule)
+            else:
+                # Multi-line text: no variable to trace
+                self.app.entries[field_name].bind("<KeyRelease>", self.schedule, add="+")
+
+    def show(self, before):
+        self.frame.pack(side=tk.RIGHT, fill=tk.Y, padx=(0, 10), pady=10, before=before)
+        self.visible = True
+        self.schedule()
+
+    def hide(self):
+        self.frame.pack_forget()
+        self.visible = False
+
+    def schedule(self, *args):
+        """Ask for a redraw at the next idle time; edits until then share it"""
+        if self.visible and not self.scheduled:
+            self.scheduled = True
+            self.canvas.after_idle(self.redraw)
+
+    def redraw(self):
+        """Redraw the fields whose value on the first page changed"""
+        self.scheduled = False
+        layout = self.renderer.load_layout()
+        if layout.fingerprint != self.layout_fingerprint:
+            # Layout file edited: every field may have moved
+            self.layout_fingerprint = layout.fingerprint
+            self.shown = {}
+            for items in self.items.values():
+                self.canvas.delete(*items)
+            self.items = {}
+        page = next(self.renderer.iter_pages(self.app.get_field_values(), layout))
+        for field_name in page.keys() | self.shown.keys():
+            value = page.get(field_name, "")
+            if value == self.shown.get(field_name, ""):
+                continue
+            if field_name in self.items:
+                self.canvas.delete(*self.items.pop(field_name))
+            ops = self.renderer.compile_field(layout, field_name, value, self.template.height)
+            if ops:
+                self.items[field_name] = [self.draw(op) for op in ops]
+        self.shown = page
+
+    def draw(self, op):
+        """Draw one operation as canvas text; returns the item"""
+        x = (op.x - self.left) * PREVIEW_SCALE
+        # PDF y is the baseline, measured up from the bottom of the page
+        y = (self.top - op.y + _DESCENT * op.font_size) * PREVIEW_SCALE
+        return self.canvas.create_text(
+            x, y, text=op.text, font=_tk_font(op), fill=_tk_color(op.color),
+            anchor="se" if op.align == self.renderer.ALIGN_RIGHT else "sw",
+        )
@@ -0,0 +1,767 @@
+#!/usr/bin/env python3
+"""
+In-process invoice renderer: fills the invoice template from a field mapping
+"""
+import functools
+import hashlib
+import io
+import json
+import os
+import threading
+import zlib
+from dataclasses import dataclass
+
+from reportlab.pdfgen import canvas
+from reportlab.pdfbase import pdfmetrics
+from pdfrw import PdfReader, PdfWriter, PageMerge, PdfDict, PdfArray, PdfName, PdfObject
+from pdfrw.buildxobj import pagexobj
+from pdfrw.pdfwriter import user_fmt
+
+from invoice_fields import LAYOUT_PATH, TEMPLATE_PATH, output_filename_for, parse_amount
+from invoice_money import cents_text, to_cents
+from invoice_trace import span
+
+FONT_NAME = "Helvetica"
+
+ALIGN_LEFT = "left"
+ALIGN_RIGHT = "right"
+
+# Overlay backends: a reportlab canvas document, or PDF text operators
+# written straight into a content stream appended to the template page
+BACKEND_CANVAS = "canvas"
+BACKEND_STREAM = "stream"
+BACKENDS = [BACKEND_CANVAS, BACKEND_STREAM]
+DEFAULT_BACKEND = BACKEND_CANVAS
+
+# Fields filled in by pagination on invoices longer than one page
+PAGE_FIELD = "page"
+BROUGHT_FORWARD_FIELD = "report_sous_total"
+CARRIED_FORWARD_FIELD = "sous_total_a_reporter"
+
+
+class InvoiceTemplate:
+    """Parsed invoice template, shared by every render in the process"""
+
+    def __init__(self, path):
+        self.path = path
+        with span("template.parse", path=os.path.basename(path)):
+            self.trailer = PdfReader(path)
+        self.page = self.trailer.pages[0]
+        llx, lly, urx, ury = [float(x) for x in self.page.MediaBox]
+        self.width = urx - llx
+        self.height = ury - lly
+
+        # Pristine background content, restored before every merge
+        self.contents = self.page.Contents
+        self.resources = self.page.Resources
+        self.media_box = self.page.MediaBox
+        self.crop_box = self.page.CropBox
+        self.rotate = self.page.Rotate
+
+        # Merging edits the shared page in place, so merge + write is serialized
+        self.lock = threading.Lock()
+        self._background = None
+
+    def reset_page(self):
+        """Put the background content back on the template page"""
+        page = self.page
+        page.Contents = self.contents
+        resources = PdfDict(self.resources)
+        if self.resources.XObject is not None:
+            resources.XObject = PdfDict(self.resources.XObject)
+        page.Resources = resources
+        page.MediaBox = self.media_box
+        page.CropBox = self.crop_box
+        page.Rotate = self.rotate
+        return page
+
+    # merge_overlay, append_overlay and write must be called with the lock held
+
+    def merge_overlay(self, overlay_page):
+        """Merge an overlay page onto the background"""
+        page = self.reset_page()
+        with span("PageMerge.render"):
+            PageMerge(page).add(overlay_page).render()
+        return page
+
+    def append_overlay(self, overlay):
+        """Append a content stream overlay to the background"""
+        page = self.reset_page()
+        with span("overlay.append"):
+            fonts = PdfDict()
+            if page.Resources.Font is not None:
+                fonts.update(page.Resources.Font)
+            fonts.update(overlay.font_resources())
+            page.Resources.Font = fonts
+
+            # Isolate the background graphics state, as PageMerge does
+            contents = self.contents
+            contents = [contents] if isinstance(contents, PdfDict) else list(contents)
+            page.Contents = PdfArray(
+                [PdfDict(indirect=True, stream="q")] + contents +
+                [_compressed_stream("Q\n" + overlay.stream())]
+            )
+        return page
+
+    def write(self, output):
+        """Write the document with the current page to a path or file object"""
+        with span("PdfWriter.write"):
+            PdfWriter(output, trailer=self.trailer).write()
+
+    def merge_and_write(self, overlay_page, output):
+        """Merge an overlay page onto the background and write the document"""
+        with self.lock:
+            self.merge_overlay(overlay_page)
+            self.write(output)
+
+    def append_and_write(self, overlay, output):
+        """Append a content stream overlay to the background and write the document"""
+        with self.lock:
+            self.append_overlay(overlay)
+            self.write(output)
+
+    def background(self):
+        """The background page as a Form XObject, built once and shared by every page using it"""
+        with self.lock:
+            if self._background is None:
+                self._background = pagexobj(self.reset_page())
+            return self._background
+
+
+# Parsed templates keyed by (path, mtime, size)
+_template_cache = {}
+_template_cache_lock = threading.Lock()
+
+
+def load_template(template_path=TEMPLATE_PATH):
+    """Get the parsed template, reading the file only when it changed"""
+    path = os.path.abspath(template_path)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _template_cache_lock:
+        template = _template_cache.get(key)
+        if template is None:
+            # Drop any stale entry for the same file
+            for stale_key in [k for k in _template_cache if k[0] == path]:
+                del _template_cache[stale_key]
+            template = _template_cache[key] = InvoiceTemplate(path)
+    return template
+
+
+def _compressed_stream(text):
+    """Build a Flate-compressed content stream object"""
+    data = zlib.compress(text.encode("latin-1")).decode("latin-1")
+    return PdfDict(indirect=True, Filter=PdfName.FlateDecode, stream=data)
+
+
+@functools.lru_cache(maxsize=None)
+def _standard_font(font_name):
+    """Shared font dictionary for a standard Type1 font, so documents write it once"""
+    return PdfDict(
+        indirect=True,
+        Type=PdfName.Font,
+        Subtype=PdfName.Type1,
+        BaseFont=PdfName(font_name),
+        Encoding=PdfName.WinAnsiEncoding,
+    )
+
+
+def _format_number(value):
+    """Format a number for a PDF content stream"""
+    text = f"{value:.4f}".rstrip("0").rstrip(".")
+    return "0" if text in ("", "-0") else text
+
+
+def _escape_text(text):
+    """Encode text as a WinAnsi PDF string literal body"""
+    escaped = []
+    for byte in text.encode("cp1252", "replace"):
+        if byte in (0x28, 0x29, 0x5c):  # ( ) \
+            escaped.append("\\" + chr(byte))
+        elif 32 <= byte < 127:
+            escaped.append(chr(byte))
+        else:
+            escaped.append(f"\\{byte:03o}")
+    return "".join(escaped)
+
+
+class ContentStreamCanvas:
+    """Canvas stand-in that writes PDF text operators into a content stream
+
+    Only supports what replay needs (standard Type1 fonts, fill color,
+    left and right aligned strings). Widths come from the built-in AFM
+    tables, so alignment matches the reportlab canvas exactly.
+    """
+
+    def __init__(self):
+        self.operators = []
+        self.font_names = {}  # font name -> resource name
+        self.font_name = FONT_NAME
+        self.font_size = 12
+
+    def setFont(self, font_name, font_size):
+        self.font_name = font_name
+        self.font_size = font_size
+
+    def setFillColorRGB(self, r, g, b):
+        self.operators.append(f"{_format_number(r)} {_format_number(g)} {_format_number(b)} rg")
+
+    def stringWidth(self, text, font_name, font_size):
+        return pdfmetrics.stringWidth(text, font_name, font_size)
+
+    def drawString(self, x, y, text):
+        resource = self.font_names.setdefault(self.font_name, f"/FInvoice{len(self.font_names) + 1}")
+        self.operators.append(
+            f"BT {resource} {_format_number(self.font_size)} Tf "
+            f"1 0 0 1 {_format_number(x)} {_format_number(y)} Tm ({_escape_text(text)}) Tj ET"
+        )
+
+    def drawRightString(self, x, y, text):
+        self.drawString(x - self.stringWidth(text, self.font_name, self.font_size), y, text)
+
+    def font_resources(self):
+        """Font dictionary entries for every font used"""
+        fonts = PdfDict()
+        for font_name, resource in self.font_names.items():
+            fonts[PdfName(resource[1:])] = _standard_font(font_name)
+        return fonts
+
+    def stream(self):
+        return "\n".join(self.operators)
+
+
+@dataclass(frozen=True)
+class DrawOp:
+    """One line of text to draw on the overlay, in PDF coordinates
+
+    x is the left edge for left-aligned text and the right edge for
+    right-aligned text. wrap_width is the width of the box the line was
+    wrapped into, or None for single-line fields.
+    """
+    field_name: str
+    text: str
+    x: float
+    y: float
+    font_name: str
+    font_size: float
+    color: tuple
+    align: str = ALIGN_LEFT
+    wrap_width: float = None
+
+
+@dataclass(frozen=True)
+class FieldLayout:
+    """Where and how one field is drawn; y is measured from the top of the page"""
+    x: float
+    y: float
+    font_name: str
+    font_size: float
+    color: tuple
+    align: str = ALIGN_LEFT
+    text_format: str = "{}"
+    wrap_width: float = None
+    wrap_min_length: int = 0
+    line_spacing: float = 12
+
+
+def _compile_field_layout(spec, defaults):
+    """Build a FieldLayout from one layout file entry"""
+    spec = dict(defaults, **spec)
+    wrap = spec.get("wrap") or {}
+    return FieldLayout(
+        x=spec["x"],
+        y=spec["y"],
+        font_name=spec["font"],
+        font_size=spec["size"],
+        color=tuple(spec["color"]),
+        align=spec["align"],
+        text_format=spec["format"],
+        wrap_width=wrap.get("width"),
+        wrap_min_length=wrap.get("min_length", 0),
+        line_spacing=wrap.get("line_spacing", 12),
+    )
+
+
+class InvoiceLayout:
+    """Layout file compiled into a field name -> FieldLayout table"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            data = f.read()
+        # Identifies this exact layout, e.g. for caching rendered output
+        self.fingerprint = hashlib.sha256(data).hexdigest()
+        spec = json.loads(data.decode("utf-8"))
+
+        defaults = spec.get("defaults", {})
+        self.fields = {
+            field_name: _compile_field_layout(field_spec, defaults)
+            for field_name, field_spec in spec.get("fields", {}).items()
+        }
+
+        # Line items repeat the same columns on every row of the table
+        self.rows_per_page = None
+        self.line_columns = ()
+        line_items = spec.get("line_items")
+        if line_items:
+            self.rows_per_page = line_items["rows"]
+            self.line_columns = tuple(line_items["columns"])
+            for i in range(1, line_items["rows"] + 1):
+                y = line_items["y"] + (i - 1) * line_items["row_height"]
+                for column, column_spec in line_items["columns"].items():
+                    self.fields[f"{column}_{i}"] = _compile_field_layout(dict(column_spec, y=y), defaults)
+
+        # Line items past the table continue on extra pages
+        pagination = spec.get("pagination", {})
+        self.subtotal_column = pagination.get("subtotal_column")
+        self.last_page_only = frozenset(pagination.get("last_page_only", ()))
+
+    def get(self, field_name):
+        """Layout of a field, or None if the field is not drawn"""
+        return self.fields.get(field_name)
+
+
+# Compiled layouts keyed by (path, mtime, size)
+_layout_cache = {}
+_layout_cache_lock = threading.Lock()
+
+
+def load_layout(layout_path=LAYOUT_PATH):
+    """Get the compiled layout, reading the file only when it changed"""
+    path = os.path.abspath(layout_path)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _layout_cache_lock:
+        layout = _layout_cache.get(key)
+        if layout is None:
+            for stale_key in [k for k in _layout_cache if k[0] == path]:
+                del _layout_cache[stale_key]
+            layout = _layout_cache[key] = InvoiceLayout(path)
+    return layout
+
+
+@functools.lru_cache(maxsize=65536)
+def text_width(text, font_name, font_size):
+    """Width of a word or character, cached per font and size"""
+    return pdfmetrics.stringWidth(text, font_name, font_size)
+
+
+def _split_long_word(word, font_name, font_size, max_width):
+    """Break a word wider than max_width into pieces that each fit"""
+    pieces = []
+    piece = ""
+    piece_width = 0.0
+    for char in word:
+        char_width = text_width(char, font_name, font_size)
+        if piece and piece_width + char_width > max_width:
+            pieces.append(piece)
+            piece, piece_width = "", 0.0
+        piece += char
+        piece_width += char_width
+    pieces.append(piece)
+    return pieces
+
+
+def wrap_text(text, font_name, font_size, max_width):
+    """Split text on spaces into lines that fit in max_width
+
+    Each word is measured once (through the width cache) and line widths
+    are accumulated, so wrapping is linear in the length of the text.
+    Words wider than the box are broken across lines.
+    """
+    space_width = text_width(" ", font_name, font_size)
+    lines = []
+    current_line = ""
+    current_width = 0.0
+    for word in text.split(" "):
+        word_width = text_width(word, font_name, font_size)
+        if current_line:
+            line_width = current_width + space_width + word_width
+            if line_width <= max_width:
+                current_line += " " + word
+                current_width = line_width
+                continue
+            lines.append(current_line)
+
+        # The word starts a new line
+        if word_width > max_width:
+            pieces = _split_long_word(word, font_name, font_size, max_width)
+            lines.extend(pieces[:-1])
+            word = pieces[-1]
+            word_width = text_width(word, font_name, font_size)
+        current_line = word
+        current_width = word_width
+    if current_line:
+        lines.append(current_line)
+    return lines
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_field(layout, field_name, value, page_height):
+    """Compile one field value into a tuple of draw operations"""
+    value = (value or "").strip()
+    if not value:
+        return ()
+
+    spec = layout.get(field_name)
+    if spec is None:
+        return ()
+
+    # Clean the value for PDF output (remove euro symbols for processing)
+    clean_value = value.replace(' €', '').replace('€', '').strip()
+    baseline = page_height - spec.y
+
+    if spec.wrap_width is not None and len(value) >= spec.wrap_min_length:
+        lines = wrap_text(clean_value, spec.font_name, spec.font_size, spec.wrap_width)
+        return tuple(
+            DrawOp(field_name, spec.text_format.format(line), spec.x, baseline - i * spec.line_spacing,
+                   spec.font_name, spec.font_size, spec.color, spec.align, spec.wrap_width)
+            for i, line in enumerate(lines)
+        )
+
+    return (DrawOp(field_name, spec.text_format.format(clean_value), spec.x, baseline,
+                   spec.font_name, spec.font_size, spec.color, spec.align),)
+
+
+def line_item_count(values, layout):
+    """Number of the last line item with a value, whatever its row"""
+    count = 0
+    for field_name, value in values.items():
+        column, _, index = field_name.rpartition("_")
+        if column in layout.line_columns and index.isdigit() and str(value or "").strip():
+            count = max(count, int(index))
+    return count
+
+
+def count_pages(values, layout=None):
+    """Number of pages the invoice takes"""
+    if layout is None:
+        layout = load_layout()
+    rows = layout.rows_per_page
+    if not rows:
+        return 1
+    return max(1, -(-line_item_count(values, layout) // rows))
+
+
+def iter_pages(values, layout=None):
+    """Split a field mapping into one field mapping per page, yielded in order
+
+    Line items past the rows of the template table go on extra pages that
+    repeat the header fields. Every page but the first shows the sub-total
+    brought forward, every page but the last the sub-total carried
+    forward, and the totals block is only filled on the last page. An
+    invoice that fits on one page is yielded unchanged.
+    """
+    if layout is None:
+        layout = load_layout()
+    page_count = count_pages(values, layout)
+    if page_count == 1:
+        yield values
+        return
+
+    rows = layout.rows_per_page
+    header = {}
+    last_page = {}
+    for field_name, value in values.items():
+        column, _, index = field_name.rpartition("_")
+        if column in layout.line_columns and index.isdigit():
+            continue
+        if field_name in layout.last_page_only:
+            last_page[field_name] = value
+        else:
+            header[field_name] = value
+
+    subtotal = 0  # cents
+    for page_index in range(page_count):
+        page = dict(header)
+        page[PAGE_FIELD] = f"{page_index + 1}/{page_count}"
+        if page_index and subtotal is not None:
+            page[BROUGHT_FORWARD_FIELD] = cents_text(subtotal)
+
+        for row in range(1, rows + 1):
+            index = page_index * rows + row
+            for column in layout.line_columns:
+                page[f"{column}_{row}"] = values.get(f"{column}_{index}", "")
+            if layout.subtotal_column and subtotal is not None:
+                amount = parse_amount(values.get(f"{layout.subtotal_column}_{index}"))
+                # A line that is not a number leaves no sub-total to carry
+                subtotal = None if amount is None else subtotal + to_cents(amount)
+
+        if page_index == page_count - 1:
+            page.update(last_page)
+        elif subtotal is not None:
+            page[CARRIED_FORWARD_FIELD] = cents_text(subtotal)
+        yield page
+
+
+def compile_fields(values, page_height, layout=None):
+    """Compile a field mapping into the list of draw operations for the overlay"""
+    if layout is None:
+        layout = load_layout()
+    ops = []
+    with span("compile_fields", fields=len(values)):
+        for field_name, value in values.items():
+            ops.extend(compile_field(layout, field_name, value, page_height))
+    return ops
+
+
+def replay(ops, c):
+    """Draw a list of operations onto a canvas-like target"""
+    font = color = None
+    for op in ops:
+        if (op.font_name, op.font_size) != font:
+            font = (op.font_name, op.font_size)
+            c.setFont(op.font_name, op.font_size)
+        if op.color != color:
+            color = op.color
+            c.setFillColorRGB(*op.color)
+        if op.align == ALIGN_RIGHT:
+            c.drawRightString(op.x, op.y, op.text)
+        else:
+            c.drawString(op.x, op.y, op.text)
+
+
+def canvas_overlay(ops, template):
+    """Draw operations onto a reportlab canvas in memory and return the overlay page"""
+    with span("overlay.draw", backend=BACKEND_CANVAS, ops=len(ops)):
+        overlay_buffer = io.BytesIO()
+        c = canvas.Canvas(overlay_buffer, pagesize=(template.width, template.height))
+        replay(ops, c)
+        # save() alone skips a page with nothing drawn on it (an empty invoice)
+        c.showPage()
+        c.save()
+        return PdfReader(fdata=overlay_buffer.getvalue()).pages[0]
+
+
+def stream_overlay(ops):
+    """Draw operations into a content stream overlay"""
+    with span("overlay.draw", backend=BACKEND_STREAM, ops=len(ops)):
+        overlay = ContentStreamCanvas()
+        replay(ops, overlay)
+        return overlay
+
+
+def render_invoice(values, template_path=TEMPLATE_PATH, backend=DEFAULT_BACKEND):
+    """Render an invoice from a field mapping and return the PDF bytes"""
+    with span("render_invoice", backend=backend, invoice=values.get("numero_de_facture", "")):
+        output = io.BytesIO()
+        if count_pages(values) > 1:
+            with CombinedWriter(output, template_path, backend) as combined:
+                combined.add_invoice(values)
+            return output.getvalue()
+
+        template = load_template(template_path)
+        ops = compile_fields(values, template.height)
+        if backend == BACKEND_STREAM:
+            template.append_and_write(stream_overlay(ops), output)
+        elif backend == BACKEND_CANVAS:
+            template.merge_and_write(canvas_overlay(ops, template), output)
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+        return output.getvalue()
+
+
+def write_invoice(values, output_path=None, template_path=TEMPLATE_PATH, backend=DEFAULT_BACKEND):
+    """Render an invoice and write it to disk, returning the output path
+
+    Multi-page invoices are streamed to the file page by page, so memory
+    does not grow with the number of line items.
+    """
+    if output_path is None:
+        output_path = output_filename_for(values.get("numero_de_facture"))
+    if count_pages(values) > 1:
+        try:
+            with CombinedWriter(output_path, template_path, backend) as combined:
+                combined.add_invoice(values)
+        except BaseException:
+            # Do not leave a truncated PDF behind
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+        return output_path
+
+    pdf_bytes = render_invoice(values, template_path, backend)
+    with open(output_path, "wb") as f:
+        f.write(pdf_bytes)
+    return output_path
+
+
+class IncrementalPdfWriter:
+    """Minimal PDF writer that writes each page to the output as soon as it is added
+
+    pdfrw's PdfWriter keeps every page in memory until write(). Here a
+    page and the objects only it uses are written out and dropped right
+    away. Objects registered with share() (the template background, fonts)
+    are written once and referenced by every page. close() writes the page
+    tree, the catalog and the cross-reference table.
+    """
+
+    def __init__(self, output):
+        if hasattr(output, "write"):
+            self.file, self.owns_file = output, False
+        else:
+            self.file, self.owns_file = open(output, "wb"), True
+        self.position = 0
+        self.offsets = []  # byte offset of object n at index n - 1
+        self.shared = {}  # id(obj) -> (object number, obj), kept for the whole document
+        self.local = {}  # same, for the objects of the page being written
+        self.pending = []
+        self.page_numbers = []
+        self._write("%PDF-1.3\n%\xe2\xe3\xcf\xd3\n")
+        self.pages_number = self._reserve()
+
+    def _write(self, text):
+        data = text.encode("latin-1")
+        self.file.write(data)
+        self.position += len(data)
+
+    def _reserve(self):
+        self.offsets.append(None)
+        return len(self.offsets)
+
+    def share(self, obj):
+        """Write obj once and reference it from every page that uses it"""
+        if id(obj) not in self.shared:
+            number = self._reserve()
+            self.shared[id(obj)] = (number, obj)
+            self.pending.append((number, obj))
+
+    def _reference(self, obj):
+        """Reference to an indirect object, queuing it to be written"""
+        entry = self.shared.get(id(obj)) or self.local.get(id(obj))
+        if entry is None:
+            entry = self.local[id(obj)] = (self._reserve(), obj)
+            self.pending.append(entry)
+        return f"{entry[0]} 0 R"
+
+    def _value(self, obj):
+        # Same rules as pdfrw: streams are always indirect objects
+        if isinstance(obj, PdfDict):
+            indirect = obj.indirect or obj.stream is not None
+        else:
+            indirect = getattr(obj, "indirect", False)
+        return self._reference(obj) if indirect else self._format(obj)
+
+    def _format(self, obj):
+        if isinstance(obj, dict):
+            if not isinstance(obj, PdfDict):
+                obj = PdfDict(obj)
+            text = "<<" + " ".join(
+                f"{getattr(key, 'encoded', None) or key} {self._value(value)}" for key, value in obj.iteritems()
+            ) + ">>"
+            if obj.stream is not None:
+                text += f"\nstream\n{obj.stream}\nendstream"
+            return text
+        if isinstance(obj, (list, tuple)):
+            return "[" + " ".join(self._value(item) for item in obj) + "]"
+        if hasattr(obj, "indirect"):
+            return str(getattr(obj, "encoded", None) or obj)
+        return user_fmt(obj)
+
+    def _flush(self):
+        while self.pending:
+            number, obj = self.pending.pop()
+            text = self._format(obj)
+            self.offsets[number - 1] = self.position
+            self._write(f"{number} 0 obj\n{text}\nendobj\n")
+
+    def add_page(self, page):
+        """Write a page dictionary and everything only it refers to"""
+        page.Parent = PdfObject(f"{self.pages_number} 0 R")
+        number = self._reserve()
+        self.pending.append((number, page))
+        self._flush()
+        self.page_numbers.append(number)
+        self.local.clear()
+
+    def close(self):
+        """Write the page tree and trailer and close the output if it was opened here"""
+        self._flush()
+        kids = " ".join(f"{number} 0 R" for number in self.page_numbers)
+        self.offsets[self.pages_number - 1] = self.position
+        self._write(f"{self.pages_number} 0 obj\n<</Type /Pages /Count {len(self.page_numbers)} "
+                    f"/Kids [{kids}]>>\nendobj\n")
+        catalog_number = self._reserve()
+        self.offsets[catalog_number - 1] = self.position
+        self._write(f"{catalog_number} 0 obj\n<</Type /Catalog /Pages {self.pages_number} 0 R>>\nendobj\n")
+
+        xref_position = self.position
+        lines = [f"xref\n0 {len(self.offsets) + 1}\n0000000000 65535 f \n"]
+        lines.extend(f"{offset:010d} 00000 n \n" for offset in self.offsets)
+        lines.append(f"trailer\n<</Size {len(self.offsets) + 1} /Root {catalog_number} 0 R>>\n"
+                     f"startxref\n{xref_position}\n%%EOF\n")
+        self._write("".join(lines))
+        if self.owns_file:
+            self.file.close()
+
+
+class CombinedWriter:
+    """Writes invoice pages into one PDF: a print run, or a multi-page invoice
+
+    The template background is stored once as a Form XObject and drawn by
+    every page, so each page only adds its own text. Pages are written to
+    the output as they are added, so memory stays flat however many pages
+    there are. Use as a context manager, or call close() at the end.
+    """
+
+    def __init__(self, output, template_path=TEMPLATE_PATH, backend=BACKEND_STREAM):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend: {backend}")
+        self.template = load_template(template_path)
+        self.backend = backend
+        self.pdf = IncrementalPdfWriter(output)
+        self.pdf.share(self.template.background())
+        self.page_count = 0
+
+    def add_page(self, values):
+        """Add one page drawn from a field mapping, without pagination"""
+        template = self.template
+        ops = compile_fields(values, template.height)
+        page = PdfDict(
+            Type=PdfName.Page,
+            MediaBox=template.media_box,
+            Resources=PdfDict(XObject=PdfDict(Background=template.background())),
+        )
+        if template.crop_box is not None:
+            page.CropBox = template.crop_box
+        if self.backend == BACKEND_STREAM:
+            overlay = stream_overlay(ops)
+            fonts = overlay.font_resources()
+            for font in fonts.values():
+                self.pdf.share(font)
+            page.Resources.Font = fonts
+            page.Contents = _compressed_stream("q /Background Do Q\n" + overlay.stream())
+        else:
+            page.Contents = _compressed_stream("q /Background Do Q")
+            with span("PageMerge.render"):
+                PageMerge(page).add(canvas_overlay(ops, template)).render()
+        with span("page.write"):
+            self.pdf.add_page(page)
+        self.page_count += 1
+
+    def add_invoice(self, values):
+        """Add every page of one invoice and return how many were added"""
+        first_page = self.page_count
+        for page in iter_pages(values):
+            self.add_page(page)
+        return self.page_count - first_page
+
+    def close(self):
+        """Finish the document"""
+        with span("PdfWriter.write", pages=self.page_count):
+            self.pdf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def render_combined(records, output, template_path=TEMPLATE_PATH):
+    """Render many field mappings as the pages of one PDF, returning the page count"""
+    with CombinedWriter(output, template_path) as combined:
+        for values in records:
+            combined.add_invoice(values)
+    return combined.page_count
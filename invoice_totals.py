@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+Invoice totals as a small dependency graph over the form fields
+
+    quantite_i, prix_unitaire_i -> total_net_i -> total_hors_taxe
+    total_net_i, taux_tva_i -> tva_5_5_pourcent, tva_10_pourcent, tva_20_pourcent
+    total_hors_taxe + TVA -> total_net_de_taxes
+    total_net_de_taxes - acompte_percu -> reste_a_payer
+
+Setting a field marks the fields computed from it dirty, and recompute()
+only recomputes those, in dependency order, stopping wherever a result
+comes out unchanged. Amounts are parsed once, when a field is set:
+quantities and unit prices exactly, everything else in cents, with the
+rounding rules of invoice_money.
+
+Each line carries a VAT rate of 5.5, 10 or 20 %. The VAT of a rate is
+worked out on the sum of the line totals at that rate; a line with no
+rate counts in none of them.
+
+A computed field can also be typed by hand (a flat-rate line, a total
+with no lines, the VAT of an invoice whose lines have no rate). That
+value is kept as long as everything it is computed from is empty; for a
+line total, until both the quantity and the unit price are filled; for a
+VAT field, as long as no line with a total is at its rate.
+
+A field typed with something that is not a number makes what is
+computed from it empty; invalid_fields() lists such fields, and
+compute_totals() reports them the same way.
+
+The GUI feeds the graph from its field traces and applies the changes
+once per idle cycle; compute_totals() runs the same graph on a field
+mapping. compute_totals_batch() gives the same result for many mappings
+at once, applying the same functions column by column instead of
+building a graph per invoice. Standard library only.
+"""
+import heapq
+import itertools
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from invoice_fields import parse_amount
+from invoice_money import format_money, scaled, scaled_line_cents, to_cents, vat_cents
+
+TOTAL_HT = "total_hors_taxe"
+TOTAL_TTC = "total_net_de_taxes"
+DEPOSIT = "acompte_percu"
+BALANCE = "reste_a_payer"
+VAT_RATES = {
+    Decimal("5.5"): "tva_5_5_pourcent",
+    Decimal("10"): "tva_10_pourcent",
+    Decimal("20"): "tva_20_pourcent",
+}
+VAT_FIELDS = tuple(VAT_RATES.values())
+DEFAULT_VAT_RATE = "20"
+LINE_INPUTS = ("quantite", "prix_unitaire")
+LINE_TOTAL = "total_net"
+LINE_RATE = "taux_tva"
+
+
+class _Invalid:
+    """Amount of a field whose text is not a number"""
+
+    def __repr__(self):
+        return "INVALID"
+
+
+INVALID = _Invalid()
+
+
+def parse_money(text):
+    """Amount of a money field in cents, None when empty, INVALID when not a number"""
+    text = str(text or "").strip()
+    if not text:
+        return None
+    amount = parse_amount(text)
+    return INVALID if amount is None else to_cents(amount)
+
+
+def parse_number(text):
+    """Exact value of a quantity or unit price, as scaled by invoice_money.scaled()"""
+    text = str(text or "").strip()
+    if not text:
+        return None
+    amount = parse_amount(text)
+    return INVALID if amount is None else scaled(amount)
+
+
+def parse_rate(text):
+    """VAT rate of a line, one of the VAT_RATES keys; None when empty, INVALID for any other rate"""
+    text = str(text or "").strip().rstrip("%").strip()
+    if not text:
+        return None
+    amount = parse_amount(text)
+    if amount is None:
+        return INVALID
+    for rate in VAT_RATES:
+        if amount == rate:
+            return rate
+    return INVALID
+
+
+def format_field(amount):
+    """Text of a computed field"""
+    if amount is None or amount is INVALID:
+        return ""
+    return format_money(amount)
+
+
+def line_total(quantity, unit_price):
+    if quantity is INVALID or unit_price is INVALID:
+        return INVALID
+    if quantity is None or unit_price is None:
+        return None
+    return scaled_line_cents(quantity, unit_price) or None
+
+
+def sum_amounts(*amounts):
+    if INVALID in amounts:
+        return INVALID
+    present = [amount for amount in amounts if amount is not None]
+    return sum(present) if present else None
+
+
+def any_present(*amounts):
+    return any(amount is not None for amount in amounts)
+
+
+def all_present(*amounts):
+    return all(amount is not None for amount in amounts)
+
+
+def _lines_at(rate, totals_and_rates):
+    """(total, rate) of the lines with a total that count towards rate, or have an unreadable rate"""
+    lines = zip(totals_and_rates[0::2], totals_and_rates[1::2])
+    return [(total, line_rate) for total, line_rate in lines
+            if total is not None and (line_rate == rate or line_rate is INVALID)]
+
+
+def vat_total(rate):
+    """VAT at rate over the interleaved amounts (total_net_1, taux_tva_1, total_net_2, ...)"""
+    def compute(*totals_and_rates):
+        lines = _lines_at(rate, totals_and_rates)
+        if not lines:
+            return None
+        if any(total is INVALID or line_rate is INVALID for total, line_rate in lines):
+            return INVALID
+        return vat_cents(sum(total for total, _ in lines), rate)
+    return compute
+
+
+def has_lines_at(rate):
+    """Whether a line with a total counts towards the VAT at rate"""
+    def has_inputs(*totals_and_rates):
+        return bool(_lines_at(rate, totals_and_rates))
+    return has_inputs
+
+
+def balance(total, deposit):
+    if total is INVALID or deposit is INVALID:
+        return INVALID
+    if total is None:
+        return None
+    return total - (deposit or 0)
+
+
+@dataclass(eq=False)
+class Node:
+    """One field of the graph"""
+    name: str
+    level: int  # computed after every node of a lower level
+    inputs: list = field(default_factory=list)
+    compute: object = None  # function of the input amounts, None for a field that is only typed
+    parse: object = parse_money
+    text: str = ""
+    amount: object = None
+    manual: bool = False  # a computed field holding a typed value
+    has_inputs: object = any_present  # whether the input amounts override a typed value
+    dependents: list = field(default_factory=list)
+
+
+class TotalsGraph:
+    """The totals fields of one invoice, recomputed incrementally"""
+
+    def __init__(self, line_count=0):
+        self.nodes = {}
+        self._dirty = []  # heap of (level, order, node)
+        self._queued = set()
+        self._order = 0
+        self.line_count = 0
+        self._add(DEPOSIT, 0)
+        self._add(TOTAL_HT, 2, (), sum_amounts)
+        for rate, name in VAT_RATES.items():
+            self._add(name, 3, (), vat_total(rate)).has_inputs = has_lines_at(rate)
+        self._add(TOTAL_TTC, 4, (TOTAL_HT,) + VAT_FIELDS, sum_amounts)
+        self._add(BALANCE, 5, (TOTAL_TTC, DEPOSIT), balance)
+        for _ in range(line_count):
+            self.add_line()
+
+    def _add(self, name, level, inputs=(), compute=None, parse=parse_money):
+        node = self.nodes[name] = Node(name, level, [self.nodes[input_name] for input_name in inputs], compute,
+                                       parse=parse)
+        for input_node in node.inputs:
+            input_node.dependents.append(node)
+        return node
+
+    def add_line(self):
+        """Add the next line item; returns its number"""
+        self.line_count += 1
+        i = self.line_count
+        for column in LINE_INPUTS:
+            self._add(f"{column}_{i}", 0, parse=parse_number)
+        rate = self._add(f"{LINE_RATE}_{i}", 0, parse=parse_rate)
+        total = self._add(f"{LINE_TOTAL}_{i}", 1, [f"{column}_{i}" for column in LINE_INPUTS], line_total)
+        total.has_inputs = all_present
+        self._link(total, self.nodes[TOTAL_HT])
+        for name in VAT_FIELDS:
+            self._link(total, self.nodes[name])
+            self._link(rate, self.nodes[name])
+        return i
+
+    def _link(self, input_node, node):
+        node.inputs.append(input_node)
+        input_node.dependents.append(node)
+
+    def __contains__(self, name):
+        return name in self.nodes
+
+    def _mark(self, node):
+        if node not in self._queued:
+            self._queued.add(node)
+            self._order += 1
+            heapq.heappush(self._dirty, (node.level, self._order, node))
+
+    def set(self, name, text):
+        """A field was typed: store it and mark what is computed from it dirty"""
+        node = self.nodes.get(name)
+        if node is None:
+            return
+        node.text = text
+        node.amount = node.parse(text)
+        if node.compute is not None:
+            node.manual = node.amount is not None
+        for dependent in node.dependents:
+            self._mark(dependent)
+
+    def load(self, values):
+        """Take every field from a mapping as is, e.g. a saved invoice, leaving nothing dirty"""
+        for node in self.nodes.values():
+            node.text = str(values.get(node.name) or "")
+            node.amount = node.parse(node.text)
+            node.manual = node.compute is not None and node.amount is not None
+        self._dirty = []
+        self._queued = set()
+
+    def invalidate(self):
+        """Mark every computed field dirty"""
+        for node in self.nodes.values():
+            if node.compute is not None:
+                self._mark(node)
+
+    @property
+    def dirty(self):
+        return bool(self._dirty)
+
+    def recompute(self):
+        """Recompute the dirty fields and return {field name: new text} for those that changed"""
+        changes = {}
+        while self._dirty:
+            _, _, node = heapq.heappop(self._dirty)
+            self._queued.discard(node)
+            amounts = [input_node.amount for input_node in node.inputs]
+            if node.manual and not node.has_inputs(*amounts):
+                continue
+            amount = node.compute(*amounts)
+            text = format_field(amount)
+            node.manual = False
+            if text == node.text and amount == node.amount:
+                continue
+            node.text = text
+            node.amount = amount
+            changes[node.name] = text
+            for dependent in node.dependents:
+                self._mark(dependent)
+        return changes
+
+    def invalid_fields(self):
+        """Fields typed with something that is not a number"""
+        return [node.name for node in self.nodes.values()
+                if node.amount is INVALID and (node.compute is None or node.manual)]
+
+    def values(self):
+        """Current text of every field of the graph"""
+        return {name: node.text for name, node in self.nodes.items()}
+
+
+def invalid_message(field_names):
+    """What is wrong with invalid fields, in the words of the form and the batch report"""
+    rates = [name for name in field_names if name.rpartition("_")[0] == LINE_RATE]
+    amounts = [name for name in field_names if name not in rates]
+    parts = []
+    if amounts:
+        parts.append("montants invalides: " + ", ".join(amounts))
+    if rates:
+        allowed = ", ".join(str(rate) for rate in VAT_RATES)
+        parts.append(f"taux de TVA invalides ({allowed}): " + ", ".join(rates))
+    return "; ".join(parts)
+
+
+def line_count_of(values):
+    """Number of the last line item field present in a mapping"""
+    count = 0
+    for field_name in values:
+        column, _, index = field_name.rpartition("_")
+        if column in LINE_INPUTS + (LINE_TOTAL, LINE_RATE) and index.isdigit():
+            count = max(count, int(index))
+    return count
+
+
+def compute_totals(values, invalid=None):
+    """A copy of a field mapping with every computed field worked out from the others
+
+    Computed fields given with nothing to compute them from are kept.
+    invalid, when given, is a list extended with the fields that are not
+    numbers, as TotalsGraph.invalid_fields().
+    """
+    graph = TotalsGraph(line_count_of(values))
+    graph.load(values)
+    graph.invalidate()
+    computed = dict(values)
+    for name, text in graph.recompute().items():
+        if text or name in computed:
+            computed[name] = text
+    if invalid is not None:
+        invalid.extend(graph.invalid_fields())
+    return computed
+
+
+def _settle(results, field_name, computed, inputs, invalid, has_inputs=any_present):
+    """Final amounts of one computed field over a column, by the graph's rules
+
+    A value typed with nothing to compute it from is kept (and listed in
+    invalid when it is not a number); otherwise the computed text is
+    written to the mapping.
+    """
+    amounts = []
+    input_rows = zip(*inputs) if inputs else itertools.repeat(())
+    for values, amount, input_amounts, invalid_fields in zip(results, computed, input_rows, invalid):
+        given = parse_money(values.get(field_name))
+        if given is not None and not has_inputs(*input_amounts):
+            if given is INVALID:
+                invalid_fields.append(field_name)
+            amounts.append(given)
+            continue
+        text = format_field(amount)
+        if text or field_name in values:
+            values[field_name] = text
+        amounts.append(amount)
+    return amounts
+
+
+def compute_totals_batch(records, invalid=None):
+    """compute_totals() of many field mappings, computed a column at a time
+
+    Each field is parsed for every invoice into one column, and each
+    total is one pass of the graph's function over its input columns.
+    The result is the same as [compute_totals(values) for values in records];
+    invalid, when given, is extended with the list of invalid fields of
+    each mapping.
+    """
+    results = [dict(values) for values in records]
+    line_count = max(map(line_count_of, results), default=0)
+    invalid_rows = [[] for _ in results]
+
+    def column(field_name, parse=parse_money):
+        amounts = [parse(values.get(field_name)) for values in results]
+        if INVALID in amounts:
+            for invalid_fields, amount in zip(invalid_rows, amounts):
+                if amount is INVALID:
+                    invalid_fields.append(field_name)
+        return amounts
+
+    no_lines = [None] * len(results)
+    line_totals = []
+    totals_and_rates = []
+    for i in range(1, line_count + 1):
+        inputs = [column(f"{input_name}_{i}", parse_number) for input_name in LINE_INPUTS]
+        line_totals.append(_settle(results, f"{LINE_TOTAL}_{i}", list(map(line_total, *inputs)), inputs,
+                                   invalid_rows, all_present))
+        totals_and_rates += [line_totals[-1], column(f"{LINE_RATE}_{i}", parse_rate)]
+    computed = list(map(sum_amounts, *line_totals)) if line_totals else no_lines
+    total_ht = _settle(results, TOTAL_HT, computed, line_totals, invalid_rows)
+    inputs = [total_ht]
+    for rate, field_name in VAT_RATES.items():
+        computed = list(map(vat_total(rate), *totals_and_rates)) if totals_and_rates else no_lines
+        inputs.append(_settle(results, field_name, computed, totals_and_rates, invalid_rows, has_lines_at(rate)))
+    total_ttc = _settle(results, TOTAL_TTC, list(map(sum_amounts, *inputs)), inputs, invalid_rows)
+    inputs = [total_ttc, column(DEPOSIT)]
+    _settle(results, BALANCE, list(map(balance, *inputs)), inputs, invalid_rows)
+    if invalid is not None:
+        invalid.extend(invalid_rows)
+    return results
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Span tracing in the Chrome trace event format, for Perfetto or chrome://tracing
+
+Tracing is off unless FACTURES_TRACE names an output file, or a tool calls
+enable(). When it is off, span() returns a shared no-op context manager,
+so the hooks cost one function call.
+
+Events are buffered and appended to the file by flush(), which also runs
+at exit. The file uses the JSON Array Format with no closing bracket,
+which the trace viewers accept, so several processes (batch workers, the
+render server) can append to the same trace. Timestamps come from
+time.perf_counter(), a system-wide monotonic clock, so spans from
+different processes line up on one timeline.
+"""
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+ENV_VAR = "FACTURES_TRACE"
+
+_path = None
+_events = []
+_lock = threading.Lock()
+_named_process = False
+_null_span = contextlib.nullcontext()
+
+
+def now_us():
+    """Current trace clock in microseconds"""
+    return time.perf_counter() * 1e6
+
+
+def enabled():
+    return _path is not None
+
+
+def trace_path():
+    """The trace file, or None when tracing is off"""
+    return _path
+
+
+def enable(path, truncate=True):
+    """Start tracing to path; child processes started afterwards trace to the same file"""
+    global _path
+    path = os.path.abspath(path)
+    if truncate or not os.path.exists(path) or os.path.getsize(path) == 0:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("[\n")
+    _path = path
+    os.environ[ENV_VAR] = path
+
+
+def add_complete(name, start_us, end_us, category="factures", **args):
+    """Record a span that has already finished"""
+    if _path is None:
+        return
+    event = {
+        "name": name, "cat": category, "ph": "X",
+        "ts": round(start_us, 3), "dur": round(end_us - start_us, 3),
+        "pid": os.getpid(), "tid": threading.get_ident(),
+    }
+    if args:
+        event["args"] = args
+    with _lock:
+        _events.append(event)
+
+
+class _Span:
+    __slots__ = ("name", "category", "args", "start")
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        add_complete(self.name, self.start, now_us(), self.category, **self.args)
+        return False
+
+
+def span(name, category="factures", **args):
+    """Context manager timing a block as one span"""
+    if _path is None:
+        return _null_span
+    return _Span(name, category, args)
+
+
+def flush():
+    """Append the buffered events to the trace file"""
+    global _named_process
+    if _path is None:
+        return
+    with _lock:
+        events = _events[:]
+        del _events[:]
+        if not _named_process:
+            # Label the process row on the timeline
+            _named_process = True
+            events.insert(0, {
+                "name": "process_name", "ph": "M", "pid": os.getpid(),
+                "args": {"name": f"{os.path.basename(sys.argv[0]) or 'python'} ({os.getpid()})"},
+            })
+    if not events:
+        return
+    data = "".join(json.dumps(event, ensure_ascii=False) + ",\n" for event in events)
+    # One append per flush, so concurrent writers never interleave inside an event
+    with open(_path, "a", encoding="utf-8") as f:
+        f.write(data)
+
+
+def _after_fork():
+    """A forked child starts with its parent's buffer, which the parent still owns"""
+    global _lock, _named_process
+    _lock = threading.Lock()
+    del _events[:]
+    _named_process = False
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+atexit.register(flush)
+
+if os.environ.get(ENV_VAR):
+    enable(os.environ[ENV_VAR], truncate=False)
@@ -1,19 +1,107 @@
 #!/usr/bin/env python3
+import time
+_START_TIME = time.perf_counter()
+
 import tkinter as tk
 from tkinter import ttk, messagebox
 from datetime import datetime
-import subprocess
 import os
+import sys
+import threading
+
+# The PDF stack (invoice_renderer: reportlab, pdfrw) is imported on first render
+from invoice_fields import output_filename_for
+from invoice_money import money_text, price_text, whole_euros_text
+from invoice_totals import DEFAULT_VAT_RATE, TotalsGraph, VAT_RATES, invalid_message
+from render_server import RenderClient
+
+class StartupProfile:
+    """Per-phase start-up timings, printed with --startup-profile"""
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.phases = []
+    
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+    
+    def report(self):
+        print("Profil de démarrage:")
+        for phase, seconds in self.phases:
+            print(f"  {phase:<28} {seconds * 1000:8.1f} ms")
+        print(f"  {'total':<28} {(self.last - self.start) * 1000:8.1f} ms")
+
+class InvoiceSearchWindow:
+    """Search window over the invoice history, with hits ranked by relevance"""
+    def __init__(self, app):
+        import invoice_ledger
+        self.app = app
+        self.ledger = invoice_ledger.open_ledger()
+        self.results = []
+        self.pending_search = None
+        
+        self.window = tk.Toplevel(app.root)
+        self.window.title("Rechercher une facture")
+        self.window.geometry("700x400")
+        
+        frame = ttk.Frame(self.window, padding=10)
+        frame.pack(fill=tk.BOTH, expand=True)
+        ttk.Label(frame, text="Mots à chercher (libellés, lieu, document, notes) :").pack(anchor="w")
+        self.query = tk.StringVar()
+        entry = ttk.Entry(frame, textvariable=self.query)
+        entry.pack(fill=tk.X, pady=(2, 8))
+        entry.focus_set()
+        
+        self.listbox = tk.Listbox(frame, font=("TkFixedFont", 9))
+        self.listbox.pack(fill=tk.BOTH, expand=True)
+        self.status = ttk.Label(frame, text="Double-cliquez sur une facture pour la recharger dans le formulaire.")
+        self.status.pack(anchor="w", pady=(5, 0))
+        
+        self.query.trace_add("write", self.schedule_search)
+        entry.bind("<Return>", lambda event: self.search())
+        self.listbox.bind("<Double-Button-1>", self.load_selected)
+        self.listbox.bind("<Return>", self.load_selected)
+    
+    def schedule_search(self, *args):
+        """Search once typing pauses, instead of on every keystroke"""
+        if self.pending_search is not None:
+            self.window.after_cancel(self.pending_search)
+        self.pending_search = self.window.after(150, self.search)
+    
+    def search(self):
+        import invoice_ledger
+        self.pending_search = None
+        self.results = self.ledger.search(self.query.get(), limit=50)
+        self.listbox.delete(0, tk.END)
+        for row in self.results:
+            excerpt = " ".join((row["extrait"] or "").split())
+            self.listbox.insert(tk.END, f"{row['numero']:<12} {row['invoice_date'] or '':<10} "
+                                        f"{row['client'][:20]:<20} {invoice_ledger.format_cents(row['amount_cents']):>12}  "
+                                        f"{excerpt}")
+        self.status.configure(text=f"{len(self.results)} facture(s) trouvée(s)")
+    
+    def load_selected(self, event=None):
+        selection = self.listbox.curselection()
+        if not selection:
+            return
+        entry = self.ledger.get(self.results[selection[0]]["numero"])
+        if entry is not None:
+            self.app.load_values(entry["fields"])
+            self.window.destroy()
 
 class InvoiceFillerGUI:
-    def __init__(self, root):
+    def __init__(self, root, profile=None):
         self.root = root
+        self.profile = profile
         self.root.title("Générateur de Factures - Global Solutions")
         self.root.geometry("900x800")
         
         # Create main frame with scrollbar
         main_frame = ttk.Frame(root)
         main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.main_frame = main_frame
         
         # Create canvas and scrollbar
         canvas = tk.Canvas(main_frame)
@@ -32,43 +120,46 @@ class InvoiceFillerGUI:
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
         
-        # Dictionary to store all field variables
+        # Dictionary to store all field variables, and their entry widgets
         self.fields = {}
+        self.entries = {}
+        
+        # Totals are recomputed from the fields they depend on, once per idle cycle
+        self.totals = TotalsGraph()
+        self.totals_scheduled = False
+        self.applying_totals = False
+        
+        # Live preview pane, built when first shown
+        self.preview = None
         
         # Title
         title_label = ttk.Label(scrollable_frame, text="Global Solutions - Générateur de Factures", 
                                font=("Arial", 16, "bold"))
         title_label.pack(pady=(0, 20))
         
-        # Create field groups
+        # Create the field groups visible at the top of the window; the rest
+        # is built once the window has been drawn
         self.create_header_fields(scrollable_frame)
         self.create_client_fields(scrollable_frame)
         self.create_project_fields(scrollable_frame)
-        self.create_invoice_items(scrollable_frame)
-        self.create_totals_fields(scrollable_frame)
-        
-        # Buttons frame
-        buttons_frame = ttk.Frame(scrollable_frame)
-        buttons_frame.pack(pady=20, fill=tk.X)
-        
-        # Generate PDF button
-        generate_btn = ttk.Button(buttons_frame, text="Générer la Facture PDF", 
-                                 command=self.generate_pdf)
-        generate_btn.pack(side=tk.LEFT, padx=(0, 10))
-        
-        # Clear all button
-        clear_btn = ttk.Button(buttons_frame, text="Effacer Tout", 
-                              command=self.clear_all_fields)
-        clear_btn.pack(side=tk.LEFT)
-        
-        # Auto-calculate button
-        calc_btn = ttk.Button(buttons_frame, text="Calculer Totaux", 
-                             command=self.auto_calculate_totals)
-        calc_btn.pack(side=tk.LEFT, padx=(10, 0))
+        self.scrollable_frame = scrollable_frame
+        self.remaining_widgets_created = False
+        canvas.bind("<Expose>", self.on_first_expose)
+        # Fallback in case the window is not exposed (e.g. started minimized)
+        root.after(300, self.create_remaining_widgets)
         
         # Store canvas reference for scrolling
         self.canvas = canvas
         
+        # Client directory, loaded in the background for the name autocomplete
+        root.after_idle(self.load_client_directory)
+        
+        # Render server, attached in the background once the window is up
+        # (set FACTURES_RENDER_SERVER=0 to always render in this process)
+        self.render_client = None
+        if os.environ.get("FACTURES_RENDER_SERVER", "1") != "0":
+            root.after_idle(self.attach_render_server)
+        
         # Optimized scrolling for Mac with smooth motion
         def _on_scroll(event):
             try:
@@ -141,6 +232,57 @@ class InvoiceFillerGUI:
         
         root.bind("<KeyPress>", _on_key)
         
+    def on_first_expose(self, event):
+        """Build the rest of the form once the visible part has been drawn"""
+        self.canvas.unbind("<Expose>")
+        self.root.after_idle(self.create_remaining_widgets)
+    
+    def create_remaining_widgets(self):
+        """Create the line items, totals and buttons after the first paint"""
+        if self.remaining_widgets_created:
+            return
+        self.remaining_widgets_created = True
+        if self.profile:
+            self.profile.mark("premier affichage")
+        
+        parent = self.scrollable_frame
+        self.create_invoice_items(parent)
+        self.create_totals_fields(parent)
+        
+        # Buttons frame
+        buttons_frame = ttk.Frame(parent)
+        buttons_frame.pack(pady=20, fill=tk.X)
+        
+        # Generate PDF button
+        generate_btn = ttk.Button(buttons_frame, text="Générer la Facture PDF", 
+                                 command=self.generate_pdf)
+        generate_btn.pack(side=tk.LEFT, padx=(0, 10))
+        
+        # Clear all button
+        clear_btn = ttk.Button(buttons_frame, text="Effacer Tout", 
+                              command=self.clear_all_fields)
+        clear_btn.pack(side=tk.LEFT)
+        
+        # Auto-calculate button
+        calc_btn = ttk.Button(buttons_frame, text="Calculer Totaux", 
+                             command=self.recalculate_totals)
+        calc_btn.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Live preview of the first page
+        preview_btn = ttk.Button(buttons_frame, text="Aperçu", 
+                                command=self.toggle_preview)
+        preview_btn.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Search in the invoice history
+        search_btn = ttk.Button(buttons_frame, text="Rechercher...", 
+                               command=self.open_search)
+        search_btn.pack(side=tk.LEFT, padx=(10, 0))
+        
+        if self.profile:
+            self.root.update_idletasks()
+            self.profile.mark("widgets restants")
+            self.profile.report()
+    
     def create_field_group(self, parent, title, fields_config):
         """Create a group of fields with a title - compact layout"""
         group_frame = ttk.LabelFrame(parent, text=title, padding=8)
@@ -172,6 +314,9 @@ class InvoiceFillerGUI:
             entry.grid(row=0, column=col*2+1, padx=(0, 15 if col == 0 else 0), sticky="ew")
             
             self.fields[field_name] = var
+            self.entries[field_name] = entry
+        
+        return group_frame
     
     def create_header_fields(self, parent):
         """Create header fields"""
@@ -190,7 +335,29 @@ class InvoiceFillerGUI:
             ("num_rc", "Numéro RC", "", 40),
             ("tva", "TVA", "", 40),
         ]
-        self.create_field_group(parent, "Informations Client", fields_config)
+        group_frame = self.create_field_group(parent, "Informations Client", fields_config)
+        
+        # Client directory buttons
+        directory_frame = ttk.Frame(group_frame)
+        directory_frame.pack(fill=tk.X, pady=(4, 0))
+        ttk.Button(directory_frame, text="Enregistrer le client", 
+                   command=self.save_client).pack(side=tk.LEFT)
+        ttk.Button(directory_frame, text="Retirer du répertoire", 
+                   command=self.delete_client).pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Autocomplete list shown under the name field while typing
+        self.client_directory = None
+        self.client_matches = []
+        self.filling_client = False
+        self.client_list = tk.Listbox(group_frame, height=6, exportselection=False)
+        self.client_list.bind("<ButtonRelease-1>", self.pick_client)
+        self.client_list.bind("<Return>", self.pick_client)
+        self.client_list.bind("<Escape>", lambda event: self.hide_client_list())
+        nom_entry = self.entries["nom"]
+        nom_entry.bind("<Down>", self.focus_client_list)
+        nom_entry.bind("<Escape>", lambda event: self.hide_client_list())
+        nom_entry.bind("<FocusOut>", lambda event: self.root.after(200, self.hide_client_list_unless_focused))
+        self.fields["nom"].trace_add("write", self.update_client_list)
     
     def create_project_fields(self, parent):
         """Create project fields"""
@@ -217,105 +384,102 @@ class InvoiceFillerGUI:
         ttk.Label(headers_frame, text="Qté", font=("Arial", 9, "bold")).grid(row=0, column=1, padx=(8, 2), sticky="w")
         ttk.Label(headers_frame, text="Prix Unit.", font=("Arial", 9, "bold")).grid(row=0, column=2, padx=(8, 2), sticky="w")
         ttk.Label(headers_frame, text="Total", font=("Arial", 9, "bold")).grid(row=0, column=3, padx=(8, 2), sticky="w")
+        ttk.Label(headers_frame, text="TVA %", font=("Arial", 9, "bold")).grid(row=0, column=4, padx=(8, 2), sticky="w")
         
         # Configure column widths to match entry fields
         headers_frame.grid_columnconfigure(0, minsize=265)  # Libellé column (increased)
         headers_frame.grid_columnconfigure(1, minsize=80)   # Qté column  
         headers_frame.grid_columnconfigure(2, minsize=95)   # Prix Unit. column
         headers_frame.grid_columnconfigure(3, minsize=95)   # Total column
+        headers_frame.grid_columnconfigure(4, minsize=60)   # TVA % column
         
-        # Create 4 rows for invoice items
-        for i in range(1, 5):
-            row_frame = ttk.Frame(items_frame)
-            row_frame.pack(fill=tk.X, pady=1)
-            
-            # Use grid for entries to match header alignment
-            # Libellé - with text wrapping/truncation
-            libelle_var = tk.StringVar()
-            libelle_entry = ttk.Entry(row_frame, textvariable=libelle_var, width=35)
-            libelle_entry.grid(row=0, column=0, padx=(0, 2), sticky="w")  # Use 'w' instead of 'ew'
-            self.fields[f"libelle_{i}"] = libelle_var
-            
-            # Quantité
-            quantite_var = tk.StringVar()
-            quantite_entry = ttk.Entry(row_frame, textvariable=quantite_var, width=10)
-            quantite_entry.grid(row=0, column=1, padx=(6, 2), sticky="ew")
-            self.fields[f"quantite_{i}"] = quantite_var
-            
-            # Prix unitaire
-            prix_var = tk.StringVar()
-            prix_entry = ttk.Entry(row_frame, textvariable=prix_var, width=12)
-            prix_entry.grid(row=0, column=2, padx=(6, 2), sticky="ew")
-            self.fields[f"prix_unitaire_{i}"] = prix_var
-            
-            # Add formatting for prix unitaire field
-            def make_prix_formatter(field_var):
-                def format_on_focus_out(event):
-                    try:
-                        value = field_var.get().strip()
-                        # Remove existing euro symbol if present
-                        value = value.replace(' €', '').replace('€', '').strip()
-                        if value and value != "0":
-                            formatted_value = f"{float(value):.2f} €"
-                            field_var.set(formatted_value)
-                    except ValueError:
-                        pass
-                return format_on_focus_out
-            
-            prix_formatter = make_prix_formatter(prix_var)
-            prix_entry.bind("<FocusOut>", prix_formatter)
-            
-            # Total (auto-calculated)
-            total_var = tk.StringVar()
-            total_entry = ttk.Entry(row_frame, textvariable=total_var, width=12)
-            total_entry.grid(row=0, column=3, padx=(6, 2), sticky="ew")
-            self.fields[f"total_net_{i}"] = total_var
-            
-            # Add formatting for total field
-            def make_total_formatter(field_var):
-                def format_on_focus_out(event):
-                    try:
-                        value = field_var.get().strip()
-                        # Remove existing euro symbol if present
-                        value = value.replace(' €', '').replace('€', '').strip()
-                        if value and value != "0":
-                            formatted_value = f"{float(value):.2f} €"
-                            field_var.set(formatted_value)
-                    except ValueError:
-                        pass
-                return format_on_focus_out
-            
-            total_formatter = make_total_formatter(total_var)
-            total_entry.bind("<FocusOut>", total_formatter)
-            
-            # Configure grid columns with proper sizing
-            row_frame.grid_columnconfigure(0, minsize=265, weight=0)  # Fixed width for libelle
-            row_frame.grid_columnconfigure(1, minsize=80, weight=0)
-            row_frame.grid_columnconfigure(2, minsize=95, weight=0)
-            row_frame.grid_columnconfigure(3, minsize=95, weight=1)   # Allow last column to expand
-            
-            # Bind calculation
-            def make_calculator(i):
-                def calculate_total(*args):
-                    try:
-                        qty = float(self.fields[f"quantite_{i}"].get() or 0)
-                        # Strip euro symbols before calculating
-                        price_str = self.fields[f"prix_unitaire_{i}"].get() or "0"
-                        price_str = price_str.replace(' €', '').replace('€', '').strip()
-                        price = float(price_str or 0)
-                        total = qty * price
-                        if total > 0:
-                            self.fields[f"total_net_{i}"].set(f"{total:.2f} €")
-                        else:
-                            self.fields[f"total_net_{i}"].set("")
-                        self.update_totals()
-                    except ValueError:
-                        self.fields[f"total_net_{i}"].set("")
-                return calculate_total
-            
-            calculator = make_calculator(i)
-            quantite_var.trace_add("write", calculator)
-            prix_var.trace_add("write", calculator)
+        self.items_frame = items_frame
+        self.item_count = 0
+        
+        # Rows past the table on the template continue on extra PDF pages
+        self.add_item_button = ttk.Button(items_frame, text="+ Ajouter une ligne",
+                                          command=self.add_item_row)
+        self.add_item_button.pack(anchor="w", pady=(5, 0))
+        
+        # Start with the 4 rows of the template table
+        for _ in range(4):
+            self.add_item_row()
+    
+    def add_item_row(self):
+        """Add one line item row below the existing ones"""
+        self.item_count += 1
+        i = self.item_count
+        self.totals.add_line()
+        row_frame = ttk.Frame(self.items_frame)
+        row_frame.pack(fill=tk.X, pady=1, before=self.add_item_button)
+        
+        # Use grid for entries to match header alignment
+        # Libellé - with text wrapping/truncation
+        libelle_var = tk.StringVar()
+        libelle_entry = ttk.Entry(row_frame, textvariable=libelle_var, width=35)
+        libelle_entry.grid(row=0, column=0, padx=(0, 2), sticky="w")  # Use 'w' instead of 'ew'
+        self.fields[f"libelle_{i}"] = libelle_var
+        
+        # Quantité
+        quantite_var = tk.StringVar()
+        quantite_entry = ttk.Entry(row_frame, textvariable=quantite_var, width=10)
+        quantite_entry.grid(row=0, column=1, padx=(6, 2), sticky="ew")
+        self.fields[f"quantite_{i}"] = quantite_var
+        
+        # Prix unitaire
+        prix_var = tk.StringVar()
+        prix_entry = ttk.Entry(row_frame, textvariable=prix_var, width=12)
+        prix_entry.grid(row=0, column=2, padx=(6, 2), sticky="ew")
+        self.fields[f"prix_unitaire_{i}"] = prix_var
+        
+        # Add formatting for prix unitaire field
+        def make_prix_formatter(field_var):
+            def format_on_focus_out(event):
+                formatted_value = price_text(field_var.get())
+                if formatted_value not in (None, field_var.get()):
+                    field_var.set(formatted_value)
+            return format_on_focus_out
+        
+        prix_formatter = make_prix_formatter(prix_var)
+        prix_entry.bind("<FocusOut>", prix_formatter)
+        
+        # Total (auto-calculated)
+        total_var = tk.StringVar()
+        total_entry = ttk.Entry(row_frame, textvariable=total_var, width=12)
+        total_entry.grid(row=0, column=3, padx=(6, 2), sticky="ew")
+        self.fields[f"total_net_{i}"] = total_var
+        
+        # Add formatting for total field
+        def make_total_formatter(field_var):
+            def format_on_focus_out(event):
+                formatted_value = money_text(field_var.get())
+                if formatted_value not in (None, field_var.get()):
+                    field_var.set(formatted_value)
+            return format_on_focus_out
+        
+        total_formatter = make_total_formatter(total_var)
+        total_entry.bind("<FocusOut>", total_formatter)
+        
+        # Taux de TVA de la ligne
+        taux_var = tk.StringVar()
+        taux_combo = ttk.Combobox(row_frame, textvariable=taux_var, width=5,
+                                  values=[str(rate) for rate in VAT_RATES])
+        taux_combo.grid(row=0, column=4, padx=(6, 2), sticky="ew")
+        self.fields[f"taux_tva_{i}"] = taux_var
+        
+        # Configure grid columns with proper sizing
+        row_frame.grid_columnconfigure(0, minsize=265, weight=0)  # Fixed width for libelle
+        row_frame.grid_columnconfigure(1, minsize=80, weight=0)
+        row_frame.grid_columnconfigure(2, minsize=95, weight=0)
+        row_frame.grid_columnconfigure(3, minsize=95, weight=0)
+        row_frame.grid_columnconfigure(4, minsize=60, weight=1)   # Allow last column to expand
+        
+        # Feed the totals
+        for field_name in (f"quantite_{i}", f"prix_unitaire_{i}", f"total_net_{i}", f"taux_tva_{i}"):
+            self.watch_totals_field(field_name)
+        taux_var.set(DEFAULT_VAT_RATE)
+        if self.preview is not None:
+            self.preview.watch_new_fields()
     
     def create_totals_fields(self, parent):
         """Create totals and tax fields - compact layout"""
@@ -365,20 +529,16 @@ class InvoiceFillerGUI:
             if field_name in ["total_hors_taxe", "tva_5_5_pourcent", "tva_10_pourcent", "tva_20_pourcent"]:
                 def make_formatter(field_var):
                     def format_on_focus_out(event):
-                        try:
-                            value = field_var.get().strip()
-                            value = value.replace(' €', '').replace('€', '').strip()
-                            if value and value != "0":
-                                formatted_value = f"{float(value):.2f} €"
-                                field_var.set(formatted_value)
-                        except ValueError:
-                            pass
+                        formatted_value = money_text(field_var.get())
+                        if formatted_value not in (None, field_var.get()):
+                            field_var.set(formatted_value)
                     return format_on_focus_out
                 
                 formatter = make_formatter(var)
                 entry.bind("<FocusOut>", formatter)
             
             self.fields[field_name] = var
+            self.watch_totals_field(field_name)
         
         # Create right column fields
         for field_name, label_text in right_fields:
@@ -396,14 +556,9 @@ class InvoiceFillerGUI:
             if field_name in ["total_net_de_taxes", "acompte_percu", "reste_a_payer"]:
                 def make_formatter(field_var):
                     def format_on_focus_out(event):
-                        try:
-                            value = field_var.get().strip()
-                            value = value.replace(' €', '').replace('€', '').strip()
-                            if value and value != "0":
-                                formatted_value = f"{float(value):.2f} €"
-                                field_var.set(formatted_value)
-                        except ValueError:
-                            pass
+                        formatted_value = money_text(field_var.get())
+                        if formatted_value not in (None, field_var.get()):
+                            field_var.set(formatted_value)
                     return format_on_focus_out
                 
                 formatter = make_formatter(var)
@@ -413,20 +568,17 @@ class InvoiceFillerGUI:
             elif field_name == "en_votre_aimable_reglement_de_la_somme_de":
                 def make_confirmation_formatter(field_var):
                     def format_on_focus_out(event):
-                        try:
-                            value = field_var.get().strip()
-                            value = value.replace(',00 €', '').replace(' €', '').replace('€', '').replace(',00', '').strip()
-                            if value and value != "0":
-                                formatted_value = f"{float(value):.0f},00 €"
-                                field_var.set(formatted_value)
-                        except ValueError:
-                            pass
+                        formatted_value = whole_euros_text(field_var.get())
+                        if formatted_value not in (None, field_var.get()):
+                            field_var.set(formatted_value)
                     return format_on_focus_out
                 
                 confirmation_formatter = make_confirmation_formatter(var)
                 entry.bind("<FocusOut>", confirmation_formatter)
             
             self.fields[field_name] = var
+            if field_name in self.totals:
+                self.watch_totals_field(field_name)
         
         # Add the special additions field below
         additions_frame = ttk.Frame(totals_frame)
@@ -458,311 +610,307 @@ class InvoiceFillerGUI:
                 self.text_widget.insert("1.0", value)
         
         self.fields["additions_speciales"] = TextVar(text_widget)
+        self.entries["additions_speciales"] = text_widget
     
-    def update_totals(self):
-        """Update total HT automatically"""
-        try:
-            total_ht = 0
-            for i in range(1, 5):
-                total_str = self.fields[f"total_net_{i}"].get()
-                if total_str:
-                    # Strip euro symbols before calculating
-                    clean_total = total_str.replace(' €', '').replace('€', '').strip()
-                    total_ht += float(clean_total)
-            
-            if total_ht > 0:
-                self.fields["total_hors_taxe"].set(f"{total_ht:.2f} €")
-            else:
-                self.fields["total_hors_taxe"].set("")
-                
-        except ValueError:
-            pass
+    def watch_totals_field(self, field_name):
+        """Pass the edits of a field to the totals graph"""
+        self.fields[field_name].trace_add("write", lambda *args: self.on_totals_field_changed(field_name))
+    
+    def on_totals_field_changed(self, field_name):
+        if self.applying_totals:
+            return
+        self.totals.set(field_name, self.fields[field_name].get())
+        if not self.totals_scheduled:
+            self.totals_scheduled = True
+            self.root.after_idle(self.apply_totals)
     
-    def auto_calculate_totals(self):
-        """Auto-calculate all totals and taxes"""
+    def apply_totals(self):
+        """Write the recomputed totals to their fields"""
+        self.totals_scheduled = False
+        changes = self.totals.recompute()
+        self.applying_totals = True
         try:
-            # Calculate total HT
-            total_ht = 0
-            for i in range(1, 5):
-                total_str = self.fields[f"total_net_{i}"].get()
-                if total_str:
-                    # Strip euro symbols before calculating
-                    clean_total = total_str.replace(' €', '').replace('€', '').strip()
-                    total_ht += float(clean_total)
-            
-            self.fields["total_hors_taxe"].set(f"{total_ht:.2f} €")
-            
-            # Calculate taxes (you can modify these rates as needed)
-            def get_clean_value(field_name):
-                value = self.fields[field_name].get() or "0"
-                return float(value.replace(' €', '').replace('€', '').strip() or 0)
-            
-            tva_5_5 = get_clean_value("tva_5_5_pourcent")
-            tva_10 = get_clean_value("tva_10_pourcent")
-            tva_20 = get_clean_value("tva_20_pourcent")
-            
-            total_ttc = total_ht + tva_5_5 + tva_10 + tva_20
-            self.fields["total_net_de_taxes"].set(f"{total_ttc:.2f} €")
-            
-            # Calculate remaining amount
-            acompte = get_clean_value("acompte_percu")
-            reste = total_ttc - acompte
-            self.fields["reste_a_payer"].set(f"{reste:.2f} €")
-            
-        except ValueError as e:
-            messagebox.showwarning("Erreur de calcul", "Vérifiez que tous les montants sont des nombres valides.")
+            for field_name, text in changes.items():
+                self.fields[field_name].set(text)
+        finally:
+            self.applying_totals = False
+    
+    def recalculate_totals(self):
+        """Recompute every total from the lines, taxes and deposit"""
+        message = self.invalid_totals_message()
+        if message:
+            messagebox.showwarning("Erreur de calcul", message)
+        self.totals.invalidate()
+        self.apply_totals()
+    
+    def invalid_totals_message(self):
+        """Warning about the fields that keep totals from being computed, or None"""
+        if self.totals.dirty:
+            self.apply_totals()
+        invalid = self.totals.invalid_fields()
+        if not invalid:
+            return None
+        return f"Certains champs empêchent le calcul des totaux.\n\n{invalid_message(invalid)}"
     
     def clear_all_fields(self):
         """Clear all form fields"""
         if messagebox.askyesno("Confirmer", "Êtes-vous sûr de vouloir effacer tous les champs ?"):
             for field_name, var in self.fields.items():
-                if field_name != "date":  # Keep current date
+                if field_name.startswith("taux_tva_"):
+                    var.set(DEFAULT_VAT_RATE)
+                elif field_name != "date":  # Keep current date
                     var.set("")
     
+    def load_client_directory(self):
+        """Load the client directory in a background thread"""
+        def load():
+            try:
+                import invoice_clients
+                import invoice_ledger
+                self.client_directory = invoice_clients.ClientDirectory(invoice_ledger.open_ledger())
+            except Exception:
+                # No autocomplete without a readable ledger
+                self.client_directory = None
+        threading.Thread(target=load, daemon=True).start()
+    
+    def update_client_list(self, *args):
+        """Show the clients whose name starts with what is typed in the name field"""
+        if self.filling_client or self.client_directory is None:
+            return
+        typed = self.fields["nom"].get()
+        matches = self.client_directory.complete(typed, limit=8)
+        if len(matches) == 1 and matches[0]["nom"] == typed.strip():
+            matches = []
+        self.client_matches = matches
+        if not matches:
+            self.hide_client_list()
+            return
+        self.client_list.delete(0, tk.END)
+        for client in matches:
+            self.client_list.insert(tk.END, f"{client['nom']}  -  {client['ville']}")
+        self.client_list.configure(height=len(matches))
+        self.client_list.place(in_=self.entries["nom"], relx=0, rely=1.0, relwidth=1.0)
+        self.client_list.lift()
+    
+    def hide_client_list(self):
+        self.client_list.place_forget()
+    
+    def hide_client_list_unless_focused(self):
+        if self.root.focus_get() is not self.client_list:
+            self.hide_client_list()
+    
+    def focus_client_list(self, event=None):
+        if self.client_matches:
+            self.client_list.focus_set()
+            self.client_list.selection_clear(0, tk.END)
+            self.client_list.selection_set(0)
+            self.client_list.activate(0)
+        return "break"
+    
+    def pick_client(self, event=None):
+        """Fill the client fields from the selected directory entry"""
+        selection = self.client_list.curselection()
+        if not selection:
+            return
+        client = self.client_matches[selection[0]]
+        self.filling_client = True
+        try:
+            for field_name in ("nom", "adresse", "ville", "num_rc", "tva"):
+                self.fields[field_name].set(client[field_name])
+        finally:
+            self.filling_client = False
+        self.hide_client_list()
+        self.entries["adresse"].focus_set()
+    
+    def client_values(self):
+        return {field_name: self.fields[field_name].get() for field_name in ("nom", "adresse", "ville", "num_rc", "tva")}
+    
+    def save_client(self):
+        """Save the client fields to the directory"""
+        if not self.fields["nom"].get().strip():
+            messagebox.showwarning("Champ manquant", "Le nom du client est obligatoire.")
+            return
+        try:
+            if self.client_directory is not None:
+                self.client_directory.save(self.client_values())
+            else:
+                import invoice_ledger
+                invoice_ledger.open_ledger().save_client(self.client_values())
+            messagebox.showinfo("Répertoire", "Client enregistré dans le répertoire.")
+        except Exception as e:
+            messagebox.showerror("Erreur", f"Le client n'a pas pu être enregistré:\n{str(e)}")
+    
+    def delete_client(self):
+        """Remove the client named in the form from the directory"""
+        nom = self.fields["nom"].get().strip()
+        if not nom or self.client_directory is None or self.client_directory.get(nom) is None:
+            messagebox.showwarning("Répertoire", "Ce client n'est pas dans le répertoire.")
+            return
+        if messagebox.askyesno("Confirmer", f"Retirer « {nom} » du répertoire des clients ?"):
+            try:
+                self.client_directory.delete(nom)
+            except Exception as e:
+                messagebox.showerror("Erreur", f"Le client n'a pas pu être retiré:\n{str(e)}")
+    
+    def toggle_preview(self):
+        """Show or hide the live preview beside the form"""
+        if self.preview is None:
+            try:
+                import invoice_preview
+                self.preview = invoice_preview.InvoicePreview(self, self.root)
+            except Exception as e:
+                messagebox.showerror("Erreur", f"L'aperçu n'a pas pu être affiché:\n{str(e)}")
+                return
+        width = self.preview.canvas.winfo_reqwidth() + 30
+        if self.preview.visible:
+            self.preview.hide()
+            width = -width
+        else:
+            self.preview.show(before=self.main_frame)
+        # Widen the window by the preview instead of squeezing the form
+        self.root.geometry(f"{self.root.winfo_width() + width}x{self.root.winfo_height()}")
+    
+    def open_search(self):
+        """Open the invoice history search window"""
+        try:
+            InvoiceSearchWindow(self)
+        except Exception as e:
+            messagebox.showerror("Erreur", f"Le registre des factures est inaccessible:\n{str(e)}")
+    
+    def load_values(self, values):
+        """Fill the form from a field mapping, e.g. an invoice from the ledger"""
+        self.create_remaining_widgets()
+        for field_name in values:
+            column, _, index = field_name.rpartition("_")
+            if column == "libelle" and index.isdigit():
+                while self.item_count < int(index):
+                    self.add_item_row()
+        # The saved totals are shown as they were, not recalculated from the lines
+        self.applying_totals = True
+        try:
+            for field_name, var in self.fields.items():
+                var.set(values.get(field_name, ""))
+        finally:
+            self.applying_totals = False
+        self.totals.load(self.get_field_values())
+    
+    def get_field_values(self):
+        """Collect the current value of every form field"""
+        return {field_name: var.get() for field_name, var in self.fields.items()}
+    
+    def attach_render_server(self):
+        """Attach to the render server, starting it if needed, without blocking the window"""
+        def attach():
+            client = RenderClient()
+            if client.ensure_running():
+                self.render_client = client
+        threading.Thread(target=attach, daemon=True).start()
+    
+    def render_pdf(self, values):
+        """Get the invoice PDF from the render cache, or render it and cache it"""
+        import invoice_cache
+        try:
+            cache = invoice_cache.open_cache()
+            return cache.render(values, self.render_uncached)
+        except OSError:
+            # Unreadable cache directory: render without it
+            return self.render_uncached(values)
+    
+    def render_uncached(self, values):
+        """Render the invoice on the render server if attached, else in this process"""
+        if self.render_client is not None:
+            try:
+                return self.render_client.render(values)
+            except (OSError, ValueError):
+                # Server went away: render locally from now on
+                self.render_client = None
+        import invoice_renderer
+        return invoice_renderer.render_invoice(values)
+    
     def generate_pdf(self):
         """Generate the PDF invoice"""
         try:
-            # Check if required fields are filled
-            if not self.fields["numero_de_facture"].get().strip():
-                messagebox.showwarning("Champ manquant", "Le numéro de facture est obligatoire.")
+            # Totals left empty by a field that is not a number would go unnoticed on the PDF
+            message = self.invalid_totals_message()
+            if message and not messagebox.askyesno(
+                    "Erreur de calcul", f"{message}\n\nLes totaux concernés resteront vides. "
+                                        "Générer la facture quand même ?"):
                 return
             
-            # Generate the filled form Python script
-            script_content = self.create_filled_form_script()
-            
-            # Write temporary script
-            with open("temp_filled_form.py", "w", encoding="utf-8") as f:
-                f.write(script_content)
-            
-            # Execute the script
-            result = subprocess.run(["python", "temp_filled_form.py"], 
-                                  cwd=".", capture_output=True, text=True)
+            # An empty invoice number takes the next one of the ledger's sequence
+            allocated = None
+            if not self.fields["numero_de_facture"].get().strip():
+                allocated = self.allocate_invoice_number()
+                if allocated is None:
+                    return
             
-            if result.returncode == 0:
-                # Clean up temp file
-                os.remove("temp_filled_form.py")
-                # Get the filename that was generated
-                invoice_number = self.fields["numero_de_facture"].get().strip()
-                if invoice_number:
-                    output_filename = f"FACTURE_{invoice_number}.pdf"
-                else:
-                    output_filename = "FACTURE_SANS_NUMERO.pdf"
-                
-                messagebox.showinfo("Succès", 
-                                  f"La facture PDF a été générée avec succès!\n\nFichier: {output_filename}")
-            else:
-                messagebox.showerror("Erreur", 
-                                   f"Erreur lors de la génération du PDF:\n{result.stderr}")
+            values = self.get_field_values()
+            output_filename = output_filename_for(values["numero_de_facture"])
+            try:
+                pdf_bytes = self.render_pdf(values)
+                with open(output_filename, "wb") as f:
+                    f.write(pdf_bytes)
+            except Exception:
+                if allocated is not None:
+                    # Nothing was written: give the number back so the numbering has no gap
+                    self.release_invoice_number(allocated)
+                raise
+            self.record_invoice(values, output_filename, pdf_bytes)
+            
+            messagebox.showinfo("Succès", 
+                              f"La facture PDF a été générée avec succès!\n\nFichier: {output_filename}")
                 
         except Exception as e:
             messagebox.showerror("Erreur", f"Une erreur s'est produite:\n{str(e)}")
     
-    def create_filled_form_script(self):
-        """Create a script that overlays text on the existing acroform PDF"""
-        script_lines = []
-        script_lines.append("# Generated filled form script")
-        script_lines.append("from reportlab.pdfgen import canvas")
-        script_lines.append("from reportlab.lib.pagesizes import A4")
-        script_lines.append("from pdfrw import PdfReader, PdfWriter, PageMerge")
-        script_lines.append("")
-        # Get invoice number for filename
-        invoice_number = self.fields["numero_de_facture"].get().strip()
-        if invoice_number:
-            output_filename = f"FACTURE_{invoice_number}.pdf"
-        else:
-            output_filename = "FACTURE_SANS_NUMERO.pdf"
-        
-        script_lines.append('bg_path = "MODELE FACTURE GLOBAL SOLUTIONS A REMPLIR.pdf"')
-        script_lines.append('overlay_path = "_text_overlay.pdf"')
-        script_lines.append(f'out_path = "{output_filename}"')
-        script_lines.append("")
-        script_lines.append("# Read background PDF to get dimensions")
-        script_lines.append("bg_pdf = PdfReader(bg_path)")
-        script_lines.append("page = bg_pdf.pages[0]")
-        script_lines.append("llx, lly, urx, ury = [float(x) for x in page.MediaBox]")
-        script_lines.append("page_width = urx - llx")
-        script_lines.append("page_height = ury - lly")
-        script_lines.append("")
-        script_lines.append("# Create canvas for text overlay")
-        script_lines.append("c = canvas.Canvas(overlay_path, pagesize=(page_width, page_height))")
-        script_lines.append("")
-        script_lines.append("# Register Roboto font (using Helvetica as fallback)")
-        script_lines.append("try:")
-        script_lines.append("    from reportlab.pdfbase import pdfutils")
-        script_lines.append("    from reportlab.pdfbase.ttfonts import TTFont")
-        script_lines.append("    # Try to use Roboto, fallback to Helvetica")
-        script_lines.append("    font_name = 'Helvetica'  # Default fallback")
-        script_lines.append("except:")
-        script_lines.append("    font_name = 'Helvetica'")
-        script_lines.append("")
-        
-        # Generate text placement for each filled field
-        for field_name, var in self.fields.items():
-            value = var.get().strip()
-            if value:
-                # Clean the value for PDF output (remove euro symbols for processing)
-                clean_value = value.replace(' €', '').replace('€', '').strip()
-                escaped_value = clean_value.replace('"', '\\"').replace('\\', '\\\\')
-                x, y = self.get_field_position(field_name)
-                if x is not None and y is not None:
-                    # Determine font size based on field position
-                    font_size = self.get_font_size_for_field(field_name)
-                    script_lines.append(f'c.setFont(font_name, {font_size})')
-                    
-                    # Set text color for specific fields
-                    if field_name in ["numero_de_facture", "date"]:
-                        script_lines.append('c.setFillColorRGB(1, 1, 1)  # White text')
-                    else:
-                        script_lines.append('c.setFillColorRGB(0, 0, 0)  # Black text')
-                    
-                    # Handle text wrapping for libelle fields and additions_speciales
-                    if (field_name.startswith("libelle_") and len(value) > 35) or field_name == "additions_speciales":
-                        # Split long text into multiple lines
-                        script_lines.append(f'# Handle long text for {field_name}')
-                        script_lines.append(f'text = "{escaped_value}"')
-                        
-                        if field_name == "additions_speciales":
-                            # Special formatting for additions_speciales: bold, hex color #262b57, 12pt font size
-                            script_lines.append(f'c.setFont(font_name + "-Bold", 12)')
-                            script_lines.append(f'c.setFillColorRGB(0.149, 0.169, 0.341)  # Hex color #262b57')
-                            script_lines.append(f'max_width = 500  # Wider width for additions speciales field')
-                        else:
-                            script_lines.append(f'max_width = 225  # Maximum width for libelle field')
-                            
-                        script_lines.append(f'words = text.split(" ")')
-                        script_lines.append(f'lines = []')
-                        script_lines.append(f'current_line = ""')
-                        script_lines.append(f'for word in words:')
-                        script_lines.append(f'    test_line = current_line + (" " if current_line else "") + word')
-                        script_lines.append(f'    if c.stringWidth(test_line, font_name, {font_size}) <= max_width:')
-                        script_lines.append(f'        current_line = test_line')
-                        script_lines.append(f'    else:')
-                        script_lines.append(f'        if current_line:')
-                        script_lines.append(f'            lines.append(current_line)')
-                        script_lines.append(f'        current_line = word')
-                        script_lines.append(f'if current_line:')
-                        script_lines.append(f'    lines.append(current_line)')
-                        script_lines.append(f'# Draw each line with 12pt spacing')
-                        script_lines.append(f'for i, line in enumerate(lines):')
-                        script_lines.append(f'    c.drawString({x}, page_height - {y} - (i * 12), line)')
-                        
-                        if field_name == "additions_speciales":
-                            # Reset font and color after additions_speciales
-                            script_lines.append(f'c.setFont(font_name, {font_size})  # Reset to normal font')
-                            script_lines.append(f'c.setFillColorRGB(0, 0, 0)  # Reset to black text')
-                    else:
-                        # Check if field is monetary and needs right alignment
-                        is_monetary = (field_name.startswith(("prix_unitaire_", "total_net_")) or 
-                                     field_name in ["total_hors_taxe", "tva_5_5_pourcent", "tva_10_pourcent", 
-                                                   "tva_20_pourcent", "total_net_de_taxes", "acompte_percu", "reste_a_payer"])
-                        
-                        if is_monetary:
-                            # Add euro symbol and right-align
-                            script_lines.append(f'text_with_euro = "{escaped_value} €"')
-                            script_lines.append(f'text_width = c.stringWidth(text_with_euro, font_name, {font_size})')
-                            script_lines.append(f'c.drawRightString({x} + 80, page_height - {y}, text_with_euro)')
-                        elif field_name == "en_votre_aimable_reglement_de_la_somme_de":
-                            # Special formatting for confirmation field: bold, hex color #262b57, with ,00 and euro
-                            script_lines.append(f'c.setFont(font_name + "-Bold", {font_size})')
-                            script_lines.append(f'c.setFillColorRGB(0.149, 0.169, 0.341)  # Hex color #262b57')
-                            script_lines.append(f'formatted_amount = "{escaped_value},00 €"')
-                            script_lines.append(f'c.drawString({x}, page_height - {y}, formatted_amount)')
-                            script_lines.append(f'c.setFont(font_name, {font_size})  # Reset to normal font')
-                            script_lines.append(f'c.setFillColorRGB(0, 0, 0)  # Reset to black text')
-                        else:
-                            # Normal single line text
-                            script_lines.append(f'c.drawString({x}, page_height - {y}, "{escaped_value}")')
-        
-        script_lines.append("")
-        script_lines.append("c.save()")
-        script_lines.append("")
-        script_lines.append("# Merge text overlay with the acroform PDF")
-        script_lines.append("bg_pdf = PdfReader(bg_path)")
-        script_lines.append("overlay_pdf = PdfReader(overlay_path)")
-        script_lines.append("")
-        script_lines.append("page_bg = bg_pdf.pages[0]")
-        script_lines.append("page_overlay = overlay_pdf.pages[0]")
-        script_lines.append("")
-        script_lines.append("merger = PageMerge(page_bg)")
-        script_lines.append("merger.add(page_overlay).render()")
-        script_lines.append("")
-        script_lines.append("PdfWriter(out_path, trailer=bg_pdf).write()")
-        script_lines.append("print('PDF generated successfully!')")
-        
-        return "\n".join(script_lines)
-    
-    def get_font_size_for_field(self, field_name):
-        """Get font size based on field position in form"""
-        # Fields before table (size 12): header and client info fields
-        before_table_fields = [
-            "numero_de_facture", "date", "nom", "adresse", "ville", 
-            "num_rc", "tva", "document", "lieu_d_intervention", 
-            "debut_du_chantier", "fin_du_chantier"
-        ]
-        
-        # Table and after table fields (size 8): libelle, quantities, totals
-        table_and_after_fields = [
-            "libelle_", "quantite_", "prix_unitaire_", "total_net_",
-            "total_hors_taxe", "tva_5_5_pourcent", "tva_10_pourcent", 
-            "tva_20_pourcent", "total_net_de_taxes", "acompte_percu", 
-            "reste_a_payer", "en_votre_aimable_reglement_de_la_somme_de", "additions_speciales"
-        ]
-        
-        # Check if field is in table or after table (size 10)
-        for pattern in table_and_after_fields:
-            if field_name.startswith(pattern) or field_name == pattern:
-                return 10
-                
-        # Check if field is before table (size 12)  
-        if field_name in before_table_fields:
-            return 12
-            
-        # Default fallback
-        return 9
-    
-    def get_field_position(self, field_name):
-        """Get the position for a field based on acroform.py positioning"""
-        positions = {
-            "numero_de_facture": (130, 71.5),
-            "date": (95, 96.5),
-            "nom": (44, 214),
-            "adresse": (44, 226),
-            "ville": (44, 238),
-            "num_rc": (44, 250),
-            "tva": (44, 262),
-            "document": (355, 203),
-            "lieu_d_intervention": (397, 227),
-            "debut_du_chantier": (393, 251),
-            "fin_du_chantier": (378, 263),
-            "total_hors_taxe": (465, 447),
-            "tva_5_5_pourcent": (465, 475),
-            "tva_10_pourcent": (465, 504),
-            "tva_20_pourcent": (465, 529),
-            "total_net_de_taxes": (465, 552),
-            "acompte_percu": (465, 572),
-            "reste_a_payer": (465, 610),
-            "en_votre_aimable_reglement_de_la_somme_de": (295, 639),
-            "additions_speciales": (47.5, 655),  # Bottom left of page for special additions (47+0.5px right)
-        }
-        
-        # Add line items positions - fill from top to bottom
-        for i in range(1, 5):
-            # Use (i-1) to fill from top: line 1 at top, line 4 at bottom
-            y_pos = 352 + (i-1) * 25
-            positions[f"libelle_{i}"] = (60, y_pos)
-            positions[f"quantite_{i}"] = (290, y_pos) 
-            positions[f"prix_unitaire_{i}"] = (360, y_pos)
-            positions[f"total_net_{i}"] = (465, y_pos)
-        
-        return positions.get(field_name, (None, None))
+    def allocate_invoice_number(self):
+        """Fill the invoice number field with the next number; returns it, or None on failure"""
+        import invoice_ledger
+        import invoice_numbers
+        try:
+            allocator = invoice_numbers.InvoiceNumberAllocator(invoice_ledger.open_ledger())
+            numero = allocator.next(invoice_numbers.invoice_date(self.get_field_values()))
+        except Exception as e:
+            messagebox.showwarning("Champ manquant", 
+                                   f"Le numéro de facture est obligatoire et n'a pas pu être attribué:\n{e}")
+            return None
+        self.fields["numero_de_facture"].set(numero)
+        return numero
+    
+    def release_invoice_number(self, numero):
+        import invoice_ledger
+        import invoice_numbers
+        try:
+            invoice_numbers.InvoiceNumberAllocator(invoice_ledger.open_ledger()).release(
+                numero, invoice_numbers.invoice_date(self.get_field_values()))
+            self.fields["numero_de_facture"].set("")
+        except Exception:
+            pass
+    
+    def record_invoice(self, values, output_filename, pdf_bytes):
+        """Record the generated invoice in the ledger; the PDF is kept even if this fails"""
+        import hashlib
+        import invoice_ledger
+        try:
+            invoice_ledger.open_ledger().record(values, output_filename, hashlib.sha256(pdf_bytes).hexdigest())
+            # The ledger also updated the client; keep the autocomplete in step
+            if self.client_directory is not None:
+                self.client_directory.index(values)
+        except Exception as e:
+            messagebox.showwarning("Registre", f"La facture n'a pas pu être enregistrée dans le registre:\n{e}")
 
 def main():
-    import os
+    profile = None
+    if "--startup-profile" in sys.argv[1:]:
+        profile = StartupProfile(_START_TIME)
+        profile.mark("imports")
     
     # Bypass macOS version check for older systems
     os.environ['SYSTEM_VERSION_COMPAT'] = '1'
     
     root = tk.Tk()
+    if profile:
+        profile.mark("fenêtre Tk")
     
     # Ensure the window appears properly when launched from app bundle
     root.lift()
@@ -770,7 +918,9 @@ def main():
     root.after_idle(lambda: root.attributes('-topmost', False))
     root.focus_force()
     
-    app = InvoiceFillerGUI(root)
+    app = InvoiceFillerGUI(root, profile)
+    if profile:
+        profile.mark("widgets visibles")
     root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Long-lived render server: keeps the PDF stack and the template loaded so
+invoices render in milliseconds, for the GUI and for batch tooling
+
+The server only talks to the user who started it. On POSIX it listens
+on a Unix socket in a per-user directory of mode 0700, which nobody else
+can reach or create. Elsewhere it listens on a random 127.0.0.1 port and
+writes the port and a random session token to a file in the user's
+private application data directory: every request must carry the token,
+and the server proves it holds the token (an HMAC of a client nonce)
+before the client sends it anything else, so a process that grabs the
+port never sees an invoice.
+
+Each message is a 4-byte big-endian length followed by a UTF-8 JSON
+object. Each response is a JSON header message, followed by
+header["size"] raw PDF bytes when the PDF is returned. A connection may
+carry several requests.
+
+Requests:
+    {"op": "ping", "nonce": "..."}
+    {"op": "render", "fields": {...}, "backend": null, "token": "..."}
+    {"op": "shutdown", "token": "..."}
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import socket
+import socketserver
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import invoice_cache
+
+HOST = "127.0.0.1"
+USE_UNIX_SOCKET = sys.platform != "win32" and hasattr(socket, "AF_UNIX")
+
+
+def _default_server_dir():
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+        return os.path.join(base, "GenerateurFactures")
+    base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(base, f"generateur-factures-{os.getuid()}")
+
+
+SERVER_DIR = os.environ.get("FACTURES_RENDER_DIR") or _default_server_dir()
+SOCKET_NAME = "rendu.sock"
+ENDPOINT_NAME = "rendu.json"  # port and token of the server, when not on a Unix socket
+
+# The server exits on its own after this long without a request
+IDLE_TIMEOUT = 30 * 60
+
+_HEADER = struct.Struct(">I")
+_MAX_MESSAGE = 64 * 1024 * 1024
+
+
+def code_version():
+    """Fingerprint of the server and rendering code, so a client never talks to a stale server"""
+    return invoice_cache.code_fingerprint("render_server")[:16]
+
+
+def server_dir(directory=SERVER_DIR):
+    """The server's directory, created if needed; PermissionError unless only this user can use it"""
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if hasattr(os, "getuid"):
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+            raise PermissionError(f"dossier du serveur de rendu d'un autre utilisateur: {directory}")
+        if info.st_mode & 0o077:
+            os.chmod(directory, 0o700)
+    return directory
+
+
+def _proof(token, nonce):
+    return hmac.new(token.encode("ascii"), nonce.encode("ascii"), hashlib.sha256).hexdigest()
+
+
+def _write_private(path, data):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def _send_message(sock, message, payload=b""):
+    data = json.dumps(message).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(data)) + data + payload)
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 16))
+        if not chunk:
+            raise ConnectionError("connexion fermée par le serveur de rendu")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_message(sock):
+    (size,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    if size > _MAX_MESSAGE:
+        raise ValueError("message trop long")
+    return json.loads(_recv_exact(sock, size).decode("utf-8"))
+
+
+class RenderRequestHandler(socketserver.BaseRequestHandler):
+    """Handles the requests of one connection until the client closes it"""
+
+    def handle(self):
+        while self.handle_one():
+            pass
+
+    def handle_one(self):
+        """Answer one request; False when the connection is done"""
+        server = self.server
+        try:
+            request = _recv_message(self.request)
+        except (ConnectionError, OSError):
+            return False
+        server.last_activity = time.monotonic()
+        try:
+            op = request.get("op")
+            if op == "ping":
+                _send_message(self.request, {"ok": True, "version": server.version, "pid": os.getpid(),
+                                             "proof": server.proof(request.get("nonce"))})
+            elif not server.authorized(request):
+                _send_message(self.request, {"ok": False, "error": "requête non autorisée"})
+                return False
+            elif op == "render":
+                self.handle_render(request)
+            elif op == "shutdown":
+                _send_message(self.request, {"ok": True})
+                threading.Thread(target=server.shutdown, daemon=True).start()
+                return False
+            else:
+                _send_message(self.request, {"ok": False, "error": f"opération inconnue: {op}"})
+            return True
+        except Exception as e:
+            try:
+                _send_message(self.request, {"ok": False, "error": str(e) or e.__class__.__name__})
+            except OSError:
+                pass
+            return False
+        finally:
+            server.last_activity = time.monotonic()
+
+    def handle_render(self, request):
+        import invoice_renderer
+        import invoice_trace
+
+        fields = request.get("fields") or {}
+        backend = request.get("backend") or invoice_renderer.DEFAULT_BACKEND
+        with invoice_trace.span("render_server.request"):
+            pdf_bytes = invoice_renderer.render_invoice(fields, backend=backend)
+            _send_message(self.request, {"ok": True, "size": len(pdf_bytes)}, pdf_bytes)
+        # The server is stopped by its idle timer or killed, so events are written as they come
+        invoice_trace.flush()
+
+
+_BaseServer = socketserver.ThreadingUnixStreamServer if USE_UNIX_SOCKET else socketserver.ThreadingTCPServer
+
+
+class RenderServer(_BaseServer):
+    daemon_threads = True
+    allow_reuse_address = False
+
+    def __init__(self, directory=SERVER_DIR):
+        directory = server_dir(directory)
+        self.token = None
+        if USE_UNIX_SOCKET:
+            address = os.path.join(directory, SOCKET_NAME)
+            try:
+                # Left behind by a server that was killed
+                os.unlink(address)
+            except FileNotFoundError:
+                pass
+        else:
+            address = (HOST, 0)
+            self.token = secrets.token_hex(32)
+        super().__init__(address, RenderRequestHandler)
+        if USE_UNIX_SOCKET:
+            self.socket_inode = os.stat(address).st_ino
+        else:
+            self.endpoint_path = os.path.join(directory, ENDPOINT_NAME)
+            _write_private(self.endpoint_path, {"port": self.server_address[1], "token": self.token,
+                                                "pid": os.getpid()})
+        self.version = code_version()
+        self.last_activity = time.monotonic()
+
+    def proof(self, nonce):
+        """Answer to a client's challenge, showing this server holds the session token"""
+        if self.token is None or not isinstance(nonce, str) or not nonce.isalnum():
+            return None
+        return _proof(self.token, nonce)
+
+    def authorized(self, request):
+        if self.token is None:
+            return True  # Unix socket: only this user can connect
+        token = request.get("token")
+        return isinstance(token, str) and hmac.compare_digest(token.encode("utf-8"), self.token.encode("ascii"))
+
+    def server_close(self):
+        super().server_close()
+        # Remove the socket or the endpoint file unless a newer server has replaced it
+        try:
+            if USE_UNIX_SOCKET:
+                if os.stat(self.server_address).st_ino == self.socket_inode:
+                    os.unlink(self.server_address)
+            else:
+                with open(self.endpoint_path, encoding="utf-8") as f:
+                    if json.load(f).get("pid") == os.getpid():
+                        os.remove(self.endpoint_path)
+        except (OSError, ValueError):
+            pass
+
+
+def _watch_idle(server, idle_timeout):
+    while True:
+        time.sleep(min(idle_timeout, 30))
+        if time.monotonic() - server.last_activity > idle_timeout:
+            server.shutdown()
+            return
+
+
+def serve(directory=SERVER_DIR, idle_timeout=IDLE_TIMEOUT):
+    """Warm up the PDF stack, then serve until shut down or idle; False when a server already runs"""
+    if RenderClient(directory).ping() is not None:
+        return False
+    server = RenderServer(directory)
+
+    import invoice_renderer
+    invoice_renderer.load_template()
+    invoice_renderer.load_layout()
+    # One throwaway render loads the font metrics and the PDF writer
+    invoice_renderer.render_invoice({"numero_de_facture": "0"})
+
+    threading.Thread(target=_watch_idle, args=(server, idle_timeout), daemon=True).start()
+    with server:
+        server.serve_forever()
+    return True
+
+
+class RenderClient:
+    """Talks to a render server, starting one in the background when needed"""
+
+    def __init__(self, directory=SERVER_DIR, timeout=30.0):
+        self.directory = directory
+        self.timeout = timeout
+        self.version = code_version()
+
+    def _connect(self, timeout):
+        """Open a connection to this user's server; returns (socket, token, ping answer)"""
+        directory = server_dir(self.directory)
+        token = None
+        if USE_UNIX_SOCKET:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = os.path.join(directory, SOCKET_NAME)
+        else:
+            with open(os.path.join(directory, ENDPOINT_NAME), encoding="utf-8") as f:
+                endpoint = json.load(f)
+            try:
+                token = str(endpoint["token"])
+                address = (HOST, int(endpoint["port"]))
+            except (KeyError, TypeError) as e:
+                raise ValueError(f"fichier du serveur de rendu illisible: {e}") from None
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(address)
+            # The server must show it holds the token before it is sent anything else
+            nonce = secrets.token_hex(16)
+            _send_message(sock, {"op": "ping", "nonce": nonce})
+            header = _recv_message(sock)
+            if token is not None and not hmac.compare_digest(str(header.get("proof")), _proof(token, nonce)):
+                raise PermissionError("le serveur de rendu ne connaît pas le jeton de la session")
+        except BaseException:
+            sock.close()
+            raise
+        return sock, token, header
+
+    def _request(self, message, timeout=None):
+        sock, token, _ = self._connect(timeout or self.timeout)
+        with sock:
+            if token is not None:
+                message = dict(message, token=token)
+            _send_message(sock, message)
+            header = _recv_message(sock)
+            if not header.get("ok"):
+                raise RuntimeError(header.get("error", "erreur du serveur de rendu"))
+            payload = _recv_exact(sock, header["size"]) if "size" in header else b""
+            return header, payload
+
+    def ping(self):
+        """The server's code version, or None if none of this user's servers answers"""
+        try:
+            sock, _, header = self._connect(timeout=1.0)
+        except (OSError, ValueError):
+            return None
+        sock.close()
+        return header.get("version")
+
+    def start(self):
+        """Launch a detached server process without waiting for it"""
+        kwargs = {}
+        if sys.platform == "win32":
+            kwargs["creationflags"] = 0x08000000  # CREATE_NO_WINDOW
+        else:
+            kwargs["start_new_session"] = True
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--dossier", self.directory],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)), **kwargs
+        )
+
+    def ensure_running(self, wait=10.0):
+        """Attach to a running server with the same code, or start one; True when ready"""
+        try:
+            server_dir(self.directory)
+        except OSError:
+            return False
+        version = self.ping()
+        if version == self.version:
+            return True
+        if version is not None:
+            # A server from an older version of the code is still running
+            try:
+                self._request({"op": "shutdown"}, timeout=2.0)
+            except (OSError, ValueError, RuntimeError):
+                return False
+            time.sleep(0.2)
+        self.start()
+
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+            if self.ping() == self.version:
+                return True
+        return False
+
+    def render(self, fields, backend=None):
+        """Render an invoice on the server and return the PDF bytes"""
+        _, payload = self._request({"op": "render", "fields": fields, "backend": backend})
+        return payload
+
+    def shutdown(self):
+        self._request({"op": "shutdown"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serveur de rendu des factures")
+    parser.add_argument("--dossier", default=SERVER_DIR, help="dossier privé du socket du serveur")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="arrêt automatique après N secondes sans requête")
+    args = parser.parse_args()
+    try:
+        started = serve(args.dossier, args.idle_timeout)
+    except PermissionError as e:
+        print(f"Erreur: {e}")
+        return 1
+    if not started:
+        print(f"Un serveur de rendu tourne déjà pour le dossier {args.dossier}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,9 @@ Script pour synchroniser les versions du générateur de factures
 import shutil
 import os
 
+from companion_files import COMPANION_FILES
+
+
 def sync_versions():
     """Synchronise la version principale avec la version portable"""
     source = "pdf_filler.py"
@@ -26,6 +29,13 @@ def sync_versions():
         else:
             print(f"⚠️  Destination introuvable: {dest}")
     
+    for module in COMPANION_FILES:
+        for dest in destinations:
+            dest_dir = os.path.dirname(dest)
+            if os.path.exists(dest_dir):
+                shutil.copy2(module, dest_dir)
+                print(f"✅ Copié {module} vers {dest_dir}")
+    
     print("\n🔄 Synchronisation terminée!")
     print("N'oublie pas de:")
     print("1. Tester les changements")